@@ -1,23 +1,141 @@
 import os
+import asyncio
+import atexit
+import bisect
+import csv
+import gzip
+import html
+import io
+import json
+import math
 import logging
+import multiprocessing
+import queue
+import random
+import re
+import signal
 import sqlite3
+import sys
+import tempfile
+import time
+import unicodedata
+import uuid
+from array import array
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 import swisseph as swe
 import pytz
 from timezonefinder import TimezoneFinder
 from geopy.geocoders import Nominatim
 from datetime import timedelta
+from collections import Counter, defaultdict, deque
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.utils.executor import start_webhook
-from openai import OpenAI, OpenAIError
+from aiohttp import web
+from openai import (
+    AsyncOpenAI, OpenAIError, RateLimitError,
+    APIConnectionError, APIStatusError, APITimeoutError,
+)
 
 # ---------------------------------
 # Logging
 # ---------------------------------
-logging.basicConfig(level=logging.INFO)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")            # json | text
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")                # уровни по категориям: "unlock=WARNING,state=DEBUG"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "astro=0.01")      # доля INFO-записей по категориям: "astro=0.01,chart=0.1"
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна запись — одна JSON-строка; uid/stage/duration_ms берутся из extra=.
+    """
+    FIELDS = ("uid", "stage", "duration_ms")
+
+    def format(self, record):
+        data = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Кладёт запись в очередь как есть: сообщение форматируется уже в потоке
+    QueueListener, а не в event loop.
+    """
+
+    def prepare(self, record):
+        return record
+
+class SampleFilter(logging.Filter):
+    """
+    Пропускает долю rate записей ниже WARNING; предупреждения и ошибки — всегда.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+class lazy:
+    """
+    Аргумент лога, который вычисляется только если запись действительно пишется.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __str__(self):
+        return str(self.fn())
+
+def _parse_env_map(value: str) -> dict:
+    pairs = (item.split("=", 1) for item in value.split(",") if "=" in item)
+    return {k.strip(): v.strip() for k, v in pairs}
+
+def setup_logging():
+    """
+    Неблокирующий логгинг: root → очередь → QueueListener (отдельный поток) → stderr.
+    Вызывается заново в каждом воркере — потоки не переживают fork.
+    """
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.setLevel(LOG_LEVEL.upper())
+    root.addHandler(LazyQueueHandler(q))
+    listener = QueueListener(q, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    for category, level in _parse_env_map(LOG_LEVELS).items():
+        logging.getLogger(f"astrobot-final.{category}").setLevel(level.upper())
+    for category, rate in _parse_env_map(LOG_SAMPLE).items():
+        cat_log = logging.getLogger(f"astrobot-final.{category}")
+        cat_log.filters = [f for f in cat_log.filters if not isinstance(f, SampleFilter)]
+        cat_log.addFilter(SampleFilter(float(rate)))
+    return listener
+
+setup_logging()
 log = logging.getLogger("astrobot-final")
+log_astro = logging.getLogger("astrobot-final.astro")    # полный astro_block
+log_chart = logging.getLogger("astrobot-final.chart")    # положения планет
+log_unlock = logging.getLogger("astrobot-final.unlock")  # попытки разблокировки
+log_state = logging.getLogger("astrobot-final.state")    # переходы состояний
+log_route = logging.getLogger("astrobot-final.route")    # маршрутизация и латентность моделей
 
 # ---------------------------------
 # Env
@@ -30,25 +148,62 @@ WEBHOOK_URL = WEBHOOK_HOST
 UNLOCK_CODE = os.getenv("UNLOCK_CODE", "ASTROVIP")
 DB_PATH = os.getenv("DB_PATH", "astrobot.sqlite3")
 PAY_URL = os.getenv("PAY_URL", "https://pay.example.com")
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", "cities15000.txt")  # дамп городов GeoNames
+GAZETTEER_RU_NAMES = os.getenv("GAZETTEER_RU_NAMES", "ru_names.txt")  # alternateNamesV2, только isolanguage=ru
 
 WEBAPP_HOST = "0.0.0.0"
 WEBAPP_PORT = int(os.getenv("PORT", 10000))
-
-if not TELEGRAM_TOKEN or not OPENAI_API_KEY or not WEBHOOK_HOST:
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))  # >1 — несколько процессов-обработчиков
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 200))   # очередь апдейтов на процесс
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 16))  # параллельных обработчиков на процесс
+WORKER_MAX_RESTARTS = int(os.getenv("WORKER_MAX_RESTARTS", 5))  # потом мастер останавливается — пусть перезапустит платформа
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", 10000))           # сколько последних update_id помним
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 5))     # разборов на странице /history
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", 1000))             # строк за один запрос при выгрузке
+SECTIONED_READINGS = os.getenv("SECTIONED_READINGS", "0") == "1"   # разбор по разделам main_topics параллельно
+SECTION_MAX_TOKENS = int(os.getenv("SECTION_MAX_TOKENS", 900))     # потолок на раздел (бюджет маршрута / число разделов)
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 10))  # сек между записями журнала токенов
+USAGE_FLUSH_SIZE = int(os.getenv("USAGE_FLUSH_SIZE", 100))           # или раньше, если накопилось столько
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", 0.5))  # сек между групповыми коммитами
+WRITE_FLUSH_SIZE = int(os.getenv("WRITE_FLUSH_SIZE", 50))             # или раньше, если накопилось столько
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") == "1"         # спекулятивная генерация
+PREFETCH_DAILY_BUDGET = int(os.getenv("PREFETCH_DAILY_BUDGET", 50))  # макс. prefetch-генераций в сутки
+FULL_REPORT_CONCURRENCY = int(os.getenv("FULL_REPORT_CONCURRENCY", 15))  # все 15 разборов сразу; 429 ждут retry-after, предохранитель не размыкают
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 3))             # повторы на 429/5xx/таймаут
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", 1.0))         # сек
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", 30.0))          # сек
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 5))                   # сбоев подряд до размыкания
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 60))                # сек
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"                     # второй запрос после p95
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+FALLBACK_MODEL = os.getenv("FALLBACK_MODEL", "gpt-4o-mini")                  # быстрая модель при деградации
+ROUTE_P95_THRESHOLD = float(os.getenv("ROUTE_P95_THRESHOLD", 60))            # сек, p95 основной модели
+ROUTE_ERROR_RATE_THRESHOLD = float(os.getenv("ROUTE_ERROR_RATE_THRESHOLD", 0.3))
+ROUTE_WINDOW = int(os.getenv("ROUTE_WINDOW", 50))                            # последних запросов в статистике
+ROUTE_STATS_TTL = float(os.getenv("ROUTE_STATS_TTL", 300))                   # сек, старые замеры забываем
+
+# `python main.py export …` работает только с базой — токены не нужны
+CLI_EXPORT = __name__ == "__main__" and sys.argv[1:2] == ["export"]
+
+if not CLI_EXPORT and (not TELEGRAM_TOKEN or not OPENAI_API_KEY or not WEBHOOK_HOST):
     raise RuntimeError("Set TELEGRAM_TOKEN, OPENAI_API_KEY, WEBHOOK_HOST")
 
 # ---------------------------------
 # Init
 # ---------------------------------
-bot = Bot(token=TELEGRAM_TOKEN, parse_mode=types.ParseMode.HTML)
+# В CLI-выгрузке клиенты создаются с заглушками и ни разу не вызываются
+bot = Bot(token=TELEGRAM_TOKEN or "0:cli", parse_mode=types.ParseMode.HTML)
 dp = Dispatcher(bot)
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY or "cli", max_retries=0)  # повторы — в generate_answer
 
 # ---------------------------------
 # DB helpers
 # ---------------------------------
 def db_init():
     with sqlite3.connect(DB_PATH) as con:
+        # WAL: чтение не блокирует запись. Режим сохраняется в файле базы,
+        # а synchronous — нет: его ставит каждое соединение (см. _apply_writes, write_usage)
+        con.execute("PRAGMA journal_mode=WAL")
         con.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -60,6 +215,16 @@ def db_init():
                 created_at TEXT
             );
         """)
+        try:
+            con.execute("ALTER TABLE users ADD COLUMN geoname_id INTEGER")
+        except sqlite3.OperationalError:
+            pass  # колонка уже есть
+        try:
+            # когда менялась строка — по нему инкрементальная выгрузка users
+            con.execute("ALTER TABLE users ADD COLUMN updated_at TEXT")
+            con.execute("UPDATE users SET updated_at=created_at")
+        except sqlite3.OperationalError:
+            pass  # колонка уже есть
         con.execute("""
             CREATE TABLE IF NOT EXISTS readings (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -71,58 +236,533 @@ def db_init():
                 created_at TEXT
             );
         """)
+        try:
+            # связь с журналом токенов: все запросы одного разбора имеют общий reading_key
+            con.execute("ALTER TABLE readings ADD COLUMN reading_key TEXT")
+        except sqlite3.OperationalError:
+            pass  # колонка уже есть
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_readings_user_created ON readings (user_id, created_at, id)"
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS idx_readings_created ON readings (created_at, id)")
+        # популярная пара для prefetch считается по индексу, без чтения prompt/answer
+        con.execute("CREATE INDEX IF NOT EXISTS idx_readings_topic ON readings (sphere, subtopic)")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, user_id)")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_users_updated ON users (updated_at, user_id)")
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TEXT,
+                user_id INTEGER,
+                tier TEXT,
+                sphere TEXT,
+                subtopic TEXT,
+                model TEXT,
+                prompt_tokens INTEGER,
+                cached_tokens INTEGER,
+                completion_tokens INTEGER,
+                latency_ms INTEGER,
+                cost_usd REAL
+            );
+        """)
+        for column in ("reading_key TEXT", "hedge_loser INTEGER DEFAULT 0"):
+            try:
+                con.execute(f"ALTER TABLE usage ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass  # колонка уже есть
+        con.execute("CREATE INDEX IF NOT EXISTS idx_usage_reading ON usage (reading_key)")
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS usage_daily (
+                day TEXT,
+                user_id INTEGER,
+                sphere TEXT,
+                model TEXT,
+                requests INTEGER DEFAULT 0,
+                prompt_tokens INTEGER DEFAULT 0,
+                cached_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                latency_ms INTEGER DEFAULT 0,
+                cost_usd REAL DEFAULT 0,
+                PRIMARY KEY (day, user_id, sphere, model)
+            );
+        """)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS export_state (
+                name TEXT PRIMARY KEY,
+                created_at TEXT,
+                last_key INTEGER,
+                exported_at TEXT
+            );
+        """)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                state TEXT,
+                last_sphere TEXT,
+                updated_at TEXT
+            );
+        """)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS charts (
+                user_id INTEGER PRIMARY KEY,
+                profile_key TEXT,
+                chart TEXT,
+                created_at TEXT
+            );
+        """)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS prefetch (
+                user_id INTEGER,
+                sphere TEXT,
+                subtopic TEXT,
+                profile_key TEXT,
+                prompt TEXT,
+                answer TEXT,
+                created_at TEXT,
+                PRIMARY KEY (user_id, sphere, subtopic)
+            );
+        """)
+        try:
+            con.execute("ALTER TABLE prefetch ADD COLUMN reading_key TEXT")
+        except sqlite3.OperationalError:
+            pass  # колонка уже есть
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS prefetch_budget (
+                day TEXT PRIMARY KEY,
+                spent INTEGER DEFAULT 0
+            );
+        """)
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS seen_updates (
+                update_id INTEGER PRIMARY KEY,
+                created_at TEXT
+            );
+        """)
         con.commit()
 
 def get_user(uid: int):
     with sqlite3.connect(DB_PATH) as con:
         cur = con.execute(
-            "SELECT user_id, paid, free_used, city, birth_date, birth_time FROM users WHERE user_id=?",
+            "SELECT user_id, paid, free_used, city, birth_date, birth_time, geoname_id FROM users WHERE user_id=?",
             (uid,)
         )
         row = cur.fetchone()
         if not row:
             return None
-        return {
+        u = {
             "user_id": row[0],
             "paid": bool(row[1]),
             "free_used": bool(row[2]),
             "city": row[3],
             "birth_date": row[4],
             "birth_time": row[5],
+            "geoname_id": row[6],
         }
+    # ещё не записанные изменения из write-behind
+    for k, v in write_behind.pending_user(uid).items():
+        u[k] = bool(v) if k in ("paid", "free_used") else v
+    return u
 
 def ensure_user(uid: int):
     u = get_user(uid)
     if u:
         return u
+    now = datetime.utcnow().isoformat()
     with sqlite3.connect(DB_PATH) as con:
         con.execute(
-            "INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)",
-            (uid, datetime.utcnow().isoformat())
+            "INSERT OR IGNORE INTO users (user_id, created_at, updated_at) VALUES (?, ?, ?)",
+            (uid, now, now)
         )
         con.commit()
     return get_user(uid)
 
+def _apply_writes(user_updates: dict, readings: list):
+    """
+    Групповой коммит: все накопленные изменения — одной транзакцией.
+    """
+    with sqlite3.connect(DB_PATH) as con:
+        # В WAL с NORMAL коммит без fsync (fsync при checkpoint): при сбое питания
+        # можно потерять последние коммиты, но база остаётся целой
+        con.execute("PRAGMA synchronous=NORMAL")
+        for uid, fields in user_updates.items():
+            cols = ",".join([f"{k}=?" for k in fields.keys()])
+            # updated_at — время самой записи (под блокировкой базы), а не постановки в очередь:
+            # по нему идёт инкрементальная выгрузка users
+            con.execute(
+                f"UPDATE users SET {cols}, updated_at=strftime('%Y-%m-%dT%H:%M:%f', 'now') WHERE user_id=?",
+                list(fields.values()) + [uid]
+            )
+        con.executemany(
+            "INSERT INTO readings (user_id, sphere, subtopic, prompt, answer, created_at, reading_key) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            readings
+        )
+        con.commit()
+
+class BatchWriter:
+    """
+    Буфер в памяти со сбросом в базу пачками: раз в interval секунд
+    или при size накопленных записях. Сбросы идут строго по очереди,
+    при ошибке пачка возвращается в буфер.
+    Пока не запущен (start) — пишет сразу.
+    """
+
+    name = "Batch"
+
+    def __init__(self, interval: float, size: int):
+        self.interval = interval
+        self.size = size
+        self.lock = asyncio.Lock()
+        self.inflight = None  # пачка, которая сейчас пишется
+        self.task = None
+        self.flushing = None
+        self.running = False
+
+    # --- что и как пишем — в наследниках ---
+    def _size(self) -> int:
+        raise NotImplementedError
+
+    def _take(self):
+        raise NotImplementedError
+
+    def _write(self, batch):
+        raise NotImplementedError
+
+    def _requeue(self, batch):
+        raise NotImplementedError
+
+    def _changed(self):
+        if not self.running:
+            self._write(self._take())
+        elif self._size() >= self.size and not self.flushing:
+            self.flushing = asyncio.create_task(self._flush_task())
+
+    async def flush(self):
+        async with self.lock:
+            if not self._size():
+                return
+            batch = self.inflight = self._take()
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception:
+                log.exception("%s flush error", self.name)
+                self._requeue(batch)
+            finally:
+                self.inflight = None
+
+    async def _flush_task(self):
+        try:
+            await self.flush()
+        finally:
+            self.flushing = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._size():
+                await self.flush()
+
+    def start(self):
+        self.running = True
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.flushing:
+            await self.flushing
+        await self.flush()
+        self.running = False
+
+class WriteBehind(BatchWriter):
+    """
+    Очередь изменений users / readings, которая сбрасывается в базу
+    одной транзакцией раз в WRITE_FLUSH_INTERVAL секунд или при WRITE_FLUSH_SIZE изменениях.
+    get_user видит ещё не записанные поля (read-your-writes).
+    """
+
+    name = "Write-behind"
+
+    def __init__(self):
+        super().__init__(WRITE_FLUSH_INTERVAL, WRITE_FLUSH_SIZE)
+        self.user_updates = {}  # uid -> {поле: значение}
+        self.readings = []      # (user_id, sphere, subtopic, prompt, answer, created_at, reading_key)
+
+    def update_user(self, uid: int, fields: dict):
+        self.user_updates.setdefault(uid, {}).update(fields)
+        self._changed()
+
+    def save_reading(self, row: tuple):
+        self.readings.append(row)
+        self._changed()
+
+    def drop_readings(self, uid: int):
+        self.readings = [r for r in self.readings if r[0] != uid]
+
+    def pending_user(self, uid: int) -> dict:
+        fields = dict(self.inflight[0].get(uid, {})) if self.inflight else {}
+        fields.update(self.user_updates.get(uid, {}))
+        return fields
+
+    def _size(self) -> int:
+        return len(self.user_updates) + len(self.readings)
+
+    def _take(self):
+        batch = (self.user_updates, self.readings)
+        self.user_updates, self.readings = {}, []
+        return batch
+
+    def _write(self, batch):
+        _apply_writes(*batch)
+
+    def _requeue(self, batch):
+        # более свежие изменения — поверх возвращённых
+        user_updates, readings = batch
+        for uid, fields in user_updates.items():
+            self.user_updates[uid] = {**fields, **self.user_updates.get(uid, {})}
+        self.readings = readings + self.readings
+
+write_behind = WriteBehind()
+
 def update_user(uid: int, **fields):
     if not fields:
         return
-    cols = ",".join([f"{k}=?" for k in fields.keys()])
-    vals = list(fields.values()) + [uid]
+    write_behind.update_user(uid, fields)
+
+def save_reading(uid: int, sphere: str, sub: str, prompt: str, answer: str, reading_key: str = None):
+    write_behind.save_reading((uid, sphere, sub, prompt, answer, datetime.utcnow().isoformat(), reading_key))
+
+def delete_history(uid: int):
+    write_behind.drop_readings(uid)
     with sqlite3.connect(DB_PATH) as con:
-        con.execute(f"UPDATE users SET {cols} WHERE user_id=?", vals)
+        con.execute("DELETE FROM readings WHERE user_id=?", (uid,))
         con.commit()
 
-def save_reading(uid: int, sphere: str, sub: str, prompt: str, answer: str):
+def readings_page(uid: int, cursor=None, limit: int = HISTORY_PAGE_SIZE, preview: int = 90):
+    """
+    Страница истории от новых к старым, keyset по (created_at, id).
+    cursor — (created_at, id) последней показанной записи. Возвращает limit + 1 строк,
+    чтобы понять, есть ли следующая страница; ответ целиком не читаем.
+    """
+    sql = "SELECT id, sphere, subtopic, created_at, substr(answer, 1, ?) FROM readings WHERE user_id=?"
+    args = [preview, uid]
+    if cursor:
+        sql += " AND (created_at, id) < (?, ?)"
+        args += list(cursor)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    args.append(limit + 1)
+    with sqlite3.connect(DB_PATH) as con:
+        return con.execute(sql, args).fetchall()
+
+def get_reading(uid: int, reading_id: int):
+    with sqlite3.connect(DB_PATH) as con:
+        return con.execute(
+            "SELECT sphere, subtopic, created_at, answer FROM readings WHERE id=? AND user_id=?",
+            (reading_id, uid)
+        ).fetchone()
+
+# Выгрузка: таблица -> (ключ для keyset, колонка порядка, колонки).
+# Колонка порядка должна расти в порядке коммитов, иначе new пропустит строку,
+# которая ещё лежала в write-behind, когда курсор ушёл дальше:
+# users меняются (paid, город…) — updated_at ставится при записи в базу;
+# readings — по id (AUTOINCREMENT выдаётся при вставке), а не по created_at из очереди.
+EXPORT_TABLES = {
+    "users": ("user_id", "updated_at", [
+        "user_id", "paid", "free_used", "city", "geoname_id", "birth_date", "birth_time", "created_at", "updated_at",
+    ]),
+    "readings": ("id", "id", ["id", "user_id", "sphere", "subtopic", "created_at", "reading_key", "answer"]),
+}
+
+def export_cursor_name(table: str) -> str:
+    # колонка порядка в имени: курсор со старой колонкой не подойдёт
+    return f"{table}:{EXPORT_TABLES[table][1]}"
+
+def export_rows(table: str, since=None, until=None, after=None, chunk: int = EXPORT_CHUNK):
+    """
+    Строки таблицы по порядку (колонка порядка, ключ) пачками по chunk.
+    Каждая пачка — отдельный короткий запрос, поэтому выгрузка не держит
+    долгую транзакцию и не мешает боту писать в базу.
+    since/until — по created_at, until не включается.
+    after — (значение колонки порядка, ключ) последней уже выгруженной строки.
+    """
+    key, ts, cols = EXPORT_TABLES[table]
+    ts_i, key_i = cols.index(ts), cols.index(key)
+    order = key if ts == key else f"{ts}, {key}"
+    cursor = after
+    while True:
+        sql = f"SELECT {', '.join(cols)} FROM {table} WHERE {ts} IS NOT NULL"
+        args = []
+        if since:
+            sql += " AND created_at >= ?"
+            args.append(since)
+        if until:
+            sql += " AND created_at < ?"
+            args.append(until)
+        if cursor and ts == key:
+            sql += f" AND {key} > ?"
+            args.append(cursor[1])
+        elif cursor:
+            sql += f" AND ({ts}, {key}) > (?, ?)"
+            args += list(cursor)
+        sql += f" ORDER BY {order} LIMIT ?"
+        args.append(chunk)
+        with sqlite3.connect(DB_PATH) as con:
+            rows = con.execute(sql, args).fetchall()
+        yield from rows
+        if len(rows) < chunk:
+            return
+        cursor = (rows[-1][ts_i], rows[-1][key_i])
+
+def get_export_cursor(name: str):
+    with sqlite3.connect(DB_PATH) as con:
+        row = con.execute("SELECT created_at, last_key FROM export_state WHERE name=?", (name,)).fetchone()
+    return tuple(row) if row else None
+
+def set_export_cursor(name: str, cursor):
     with sqlite3.connect(DB_PATH) as con:
         con.execute(
-            "INSERT INTO readings (user_id, sphere, subtopic, prompt, answer, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-            (uid, sphere, sub, prompt, answer, datetime.utcnow().isoformat())
+            "INSERT OR REPLACE INTO export_state (name, created_at, last_key, exported_at) VALUES (?, ?, ?, ?)",
+            (name, cursor[0], cursor[1], datetime.utcnow().isoformat())
         )
         con.commit()
 
-def delete_history(uid: int):
+def write_usage(batch):
+    """
+    Пачка записей журнала токенов + обновление суточных сводок — одной транзакцией.
+    batch: [(created_at, user_id, tier, sphere, subtopic, model,
+             prompt_tokens, cached_tokens, completion_tokens, latency_ms, cost_usd,
+             reading_key, hedge_loser)]
+    """
     with sqlite3.connect(DB_PATH) as con:
-        con.execute("DELETE FROM readings WHERE user_id=?", (uid,))
+        con.execute("PRAGMA synchronous=NORMAL")  # как в _apply_writes
+        con.executemany(
+            "INSERT INTO usage (created_at, user_id, tier, sphere, subtopic, model, prompt_tokens, "
+            "cached_tokens, completion_tokens, latency_ms, cost_usd, reading_key, hedge_loser) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            batch
+        )
+        con.executemany(
+            "INSERT INTO usage_daily (day, user_id, sphere, model, requests, prompt_tokens, cached_tokens, "
+            "completion_tokens, latency_ms, cost_usd) VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(day, user_id, sphere, model) DO UPDATE SET "
+            "requests=requests+1, prompt_tokens=prompt_tokens+excluded.prompt_tokens, "
+            "cached_tokens=cached_tokens+excluded.cached_tokens, "
+            "completion_tokens=completion_tokens+excluded.completion_tokens, "
+            "latency_ms=latency_ms+excluded.latency_ms, cost_usd=cost_usd+excluded.cost_usd",
+            [(r[0][:10], r[1], r[3], r[5], r[6], r[7], r[8], r[9], r[10]) for r in batch]
+        )
+        con.commit()
+
+def usage_daily_totals(days: int = 7):
+    with sqlite3.connect(DB_PATH) as con:
+        return con.execute(
+            "SELECT day, SUM(requests), COUNT(DISTINCT user_id), SUM(prompt_tokens), SUM(cached_tokens), "
+            "SUM(completion_tokens), SUM(latency_ms) / MAX(SUM(requests), 1), SUM(cost_usd) "
+            "FROM usage_daily WHERE day >= ? GROUP BY day ORDER BY day DESC",
+            ((datetime.utcnow() - timedelta(days=days - 1)).date().isoformat(),)
+        ).fetchall()
+
+def usage_by_sphere(day: str):
+    with sqlite3.connect(DB_PATH) as con:
+        return con.execute(
+            "SELECT sphere, SUM(requests), SUM(prompt_tokens + completion_tokens), SUM(cost_usd) "
+            "FROM usage_daily WHERE day=? GROUP BY sphere ORDER BY SUM(cost_usd) DESC",
+            (day,)
+        ).fetchall()
+
+def load_chart(uid: int, key: str):
+    with sqlite3.connect(DB_PATH) as con:
+        row = con.execute(
+            "SELECT chart FROM charts WHERE user_id=? AND profile_key=?", (uid, key)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def store_chart(uid: int, key: str, chart: dict):
+    with sqlite3.connect(DB_PATH) as con:
+        con.execute(
+            "INSERT OR REPLACE INTO charts (user_id, profile_key, chart, created_at) VALUES (?, ?, ?, ?)",
+            (uid, key, json.dumps(chart, ensure_ascii=False), datetime.utcnow().isoformat())
+        )
+        con.commit()
+
+def popular_reading_pair():
+    with sqlite3.connect(DB_PATH) as con:
+        row = con.execute(
+            "SELECT sphere, subtopic FROM readings GROUP BY sphere, subtopic ORDER BY COUNT(*) DESC LIMIT 1"
+        ).fetchone()
+    return tuple(row) if row else None
+
+def store_prefetch(uid: int, sphere: str, sub: str, key: str, prompt: str, answer: str, reading_key: str):
+    with sqlite3.connect(DB_PATH) as con:
+        con.execute(
+            "INSERT OR REPLACE INTO prefetch (user_id, sphere, subtopic, profile_key, prompt, answer, created_at, "
+            "reading_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (uid, sphere, sub, key, prompt, answer, datetime.utcnow().isoformat(), reading_key)
+        )
+        con.commit()
+
+def take_prefetch_budget(day: str, limit: int) -> bool:
+    """
+    Атомарно списывает одну prefetch-генерацию из дневного бюджета.
+    Счётчик в базе — общий для всех воркеров и переживает рестарты.
+    """
+    if limit <= 0:
+        return False
+    with sqlite3.connect(DB_PATH) as con:
+        cur = con.execute(
+            "INSERT INTO prefetch_budget (day, spent) VALUES (?, 1) "
+            "ON CONFLICT(day) DO UPDATE SET spent=spent+1 WHERE spent < ?",
+            (day, limit)
+        )
+        con.commit()
+        return bool(cur.rowcount)
+
+def has_prefetch(uid: int, sphere: str, sub: str, key: str) -> bool:
+    with sqlite3.connect(DB_PATH) as con:
+        row = con.execute(
+            "SELECT 1 FROM prefetch WHERE user_id=? AND sphere=? AND subtopic=? AND profile_key=?",
+            (uid, sphere, sub, key)
+        ).fetchone()
+    return bool(row)
+
+def pop_prefetch(uid: int, sphere: str, sub: str, key: str):
+    with sqlite3.connect(DB_PATH) as con:
+        row = con.execute(
+            "SELECT prompt, answer, reading_key FROM prefetch "
+            "WHERE user_id=? AND sphere=? AND subtopic=? AND profile_key=?",
+            (uid, sphere, sub, key)
+        ).fetchone()
+        if row:
+            con.execute(
+                "DELETE FROM prefetch WHERE user_id=? AND sphere=? AND subtopic=?", (uid, sphere, sub)
+            )
+            con.commit()
+    return tuple(row) if row else None
+
+def mark_update_seen(update_id: int) -> bool:
+    """
+    True — апдейт новый; False — Telegram прислал его повторно.
+    Храним скользящее окно последних DEDUP_WINDOW update_id.
+    Вызывается на каждый вебхук — из потока (asyncio.to_thread), не в event loop.
+    """
+    with sqlite3.connect(DB_PATH) as con:
+        # без fsync на каждый апдейт; при сбое питания теряются лишь последние id —
+        # худший случай: один повтор Telegram будет обработан дважды
+        con.execute("PRAGMA synchronous=NORMAL")
+        cur = con.execute(
+            "INSERT OR IGNORE INTO seen_updates (update_id, created_at) VALUES (?, ?)",
+            (update_id, datetime.utcnow().isoformat())
+        )
+        if cur.rowcount and update_id % 100 == 0:
+            con.execute("DELETE FROM seen_updates WHERE update_id <= ?", (update_id - DEDUP_WINDOW,))
+        con.commit()
+        return bool(cur.rowcount)
+
+def unmark_update_seen(update_id: int):
+    with sqlite3.connect(DB_PATH) as con:
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("DELETE FROM seen_updates WHERE update_id=?", (update_id,))
         con.commit()
 
 # ---------------------------------
@@ -132,11 +772,13 @@ sphere_kb = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton("🧬 Личность"), KeyboardButton("💰 Деньги")],
         [KeyboardButton("💼 Карьера"), KeyboardButton("❤️ Отношения")],
-        [KeyboardButton("🌟 Предназначение")]
+        [KeyboardButton("🌟 Предназначение"), KeyboardButton("📚 Полный разбор")]
     ],
     resize_keyboard=True
 )
 
+FULL_REPORT_BUTTON = "📚 Полный разбор"
+
 sub_kb = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton("📖 Общее описание")],
@@ -152,17 +794,49 @@ help_kb = InlineKeyboardMarkup().add(
 )
 
 # ---------------------------------
-# State (in-memory)
+# State (таблица sessions + кэш на время апдейта)
 # ---------------------------------
 STATE_WAIT_CITY = "wait_city"
 STATE_WAIT_DATE = "wait_date"
 STATE_WAIT_TIME = "wait_time"
 STATE_READY = "ready"
 
-user_state = {}  # per-user ephemeral state
+# Состояние диалога живёт в таблице sessions: перед каждым апдейтом строка
+# перечитывается по ключу (см. process_update_serial), а изменения пишутся сразу,
+# мимо write-behind, — другой воркер или инстанс на той же базе видит их
+# на следующем апдейте. Кэш нужен только внутри одного апдейта: фильтры
+# хендлеров спрашивают get_state по многу раз.
+user_state = {}  # uid -> {"state": ..., "last_sphere": ...}
+
+def _load_session(uid):
+    s = user_state.get(uid)
+    if s is None:
+        with sqlite3.connect(DB_PATH) as con:
+            row = con.execute(
+                "SELECT state, last_sphere FROM sessions WHERE user_id=?", (uid,)
+            ).fetchone()
+        s = {"state": row[0], "last_sphere": row[1]} if row else {"state": None, "last_sphere": None}
+        user_state[uid] = s
+    return s
+
+def _save_session(uid, **fields):
+    s = _load_session(uid)
+    s.update(fields)
+    with sqlite3.connect(DB_PATH) as con:
+        con.execute("PRAGMA synchronous=NORMAL")  # как в _apply_writes
+        con.execute(
+            "INSERT INTO sessions (user_id, state, last_sphere, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET state=excluded.state, "
+            "last_sphere=excluded.last_sphere, updated_at=excluded.updated_at",
+            (uid, s["state"], s["last_sphere"], datetime.utcnow().isoformat())
+        )
+        con.commit()
+
+def set_state(uid, state): _save_session(uid, state=state)
+def get_state(uid): return _load_session(uid)["state"]
 
-def set_state(uid, state): user_state[uid] = state
-def get_state(uid): return user_state.get(uid)
+def set_last_sphere(uid, sphere): _save_session(uid, last_sphere=sphere)
+def get_last_sphere(uid): return _load_session(uid)["last_sphere"]
 
 def fmt_profile(u):
     return (
@@ -226,6 +900,14 @@ main_topics = {
 # ---------------------------------
 # Helpers
 # ---------------------------------
+_spawned = set()  # ссылки на фоновые задачи, чтобы их не собрал GC
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _spawned.add(task)
+    task.add_done_callback(_spawned.discard)
+    return task
+
 def _valid_date(s: str) -> bool:
     try:
         datetime.strptime(s.strip(), "%d.%m.%Y")
@@ -273,7 +955,7 @@ VALID_CODES = {
 async def try_unlock(message):
     code = (message.text or "").strip()
     uid = message.from_user.id
-    log.info(f"🔑 Проверка одноразового кода: {code} от пользователя {uid}")
+    log_unlock.info("🔑 Проверка кода: %s от пользователя %s", code, uid, extra={"uid": uid, "stage": "unlock"})
 
     if code in VALID_CODES:
         # ✅ Код больше не удаляем — теперь он бессрочный
@@ -282,7 +964,7 @@ async def try_unlock(message):
             "✅ Доступ открыт! Теперь ты можешь пользоваться всеми разделами без ограничений 🎉",
             reply_markup=sphere_kb
         )
-        log.info(f"🔓 Пользователь {uid} разблокирован кодом {code}")
+        log_unlock.info("🔓 Пользователь %s разблокирован кодом %s", uid, code, extra={"uid": uid, "stage": "unlock"})
         return True
 
     elif code.upper() == "ASTROVIP":
@@ -291,12 +973,232 @@ async def try_unlock(message):
             "✅ VIP-доступ активирован навсегда ✨",
             reply_markup=sphere_kb
         )
-        log.info(f"🔓 Пользователь {uid} активировал VIP-доступ")
+        log_unlock.info("🔓 Пользователь %s активировал VIP-доступ", uid, extra={"uid": uid, "stage": "unlock"})
         return True
 
     return False
 
 
+# =========================
+# 🗺 Газеттир: офлайн-поиск городов (дамп GeoNames)
+# =========================
+_TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z",
+    "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p",
+    "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch",
+    "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+    "і": "i", "ї": "i", "є": "e", "ґ": "g", "ў": "u",
+}
+
+def city_key(name: str) -> str:
+    """
+    Ключ поиска: нижний регистр, без диакритики, пробелов и дефисов,
+    кириллица транслитерирована — «Санкт-Петербург» и «Sankt-Peterburg» совпадают.
+    """
+    name = name.lower().replace("ё", "е")
+    out = []
+    for ch in unicodedata.normalize("NFKD", name):
+        if ch in _TRANSLIT:
+            out.append(_TRANSLIT[ch])
+        elif ch.isascii() and ch.isalnum():
+            out.append(ch)
+    # разные варианты транслитерации (й/ий/ый/y/iy) сводим к одному «i»
+    return re.sub("i+", "i", "".join(out).replace("y", "i"))
+
+def _is_cyrillic(s: str) -> bool:
+    return any("а" <= ch <= "я" or ch == "ё" for ch in s.lower())
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Расстояние Левенштейна с ранним выходом: > limit → limit + 1.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+class Gazetteer:
+    """
+    Компактный индекс городов: координаты/население/таймзоны в array,
+    отсортированные ключи для точного и префиксного поиска (bisect),
+    отдельный список основных ключей для нечёткого поиска.
+    """
+
+    def __init__(self):
+        self.names = []            # отображаемое имя (по возможности по-русски)
+        self.countries = []
+        self.geoname_ids = array("I")
+        self.lat = array("f")
+        self.lon = array("f")
+        self.population = array("I")
+        self.tz_idx = array("H")
+        self.tz_names = []
+        self.keys = []             # отсортированные ключи всех вариантов названий
+        self.key_ids = array("I")  # индекс города для каждого ключа
+        self.primary_keys = []     # отсортированные основные ключи (для fuzzy)
+        self.primary_ids = array("I")
+        self.by_geoname = {}
+
+    @classmethod
+    def load(cls, path: str, ru_names_path: str = None) -> "Gazetteer":
+        g = cls()
+        tz_lookup = {}
+        entries, base_keys = [], []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) < 18:
+                    continue
+                alternates = [a for a in cols[3].split(",") if a]
+                i = len(g.names)
+                # У alternatenames нет языка — русское имя берём только из ru_names
+                g.names.append(cols[1])
+                g.countries.append(cols[8])
+                g.geoname_ids.append(int(cols[0]))
+                g.lat.append(float(cols[4]))
+                g.lon.append(float(cols[5]))
+                g.population.append(int(cols[14] or 0))
+                tz = cols[17]
+                if tz not in tz_lookup:
+                    tz_lookup[tz] = len(g.tz_names)
+                    g.tz_names.append(tz)
+                g.tz_idx.append(tz_lookup[tz])
+                g.by_geoname[int(cols[0])] = i
+
+                cyrillic = {city_key(a) for a in alternates if _is_cyrillic(a)}
+                keys = {city_key(cols[1]), city_key(cols[2])} | cyrillic
+                keys.update(city_key(a) for a in alternates if a.isascii())
+                entries.extend((k, i) for k in keys if k)
+                # для fuzzy: ASCII-имя и кириллические варианты — опечатки в русском вводе
+                # находятся и без ru_names
+                base_keys.append({city_key(cols[2])} | cyrillic)
+
+        if ru_names_path and os.path.exists(ru_names_path):
+            for i, name in g._load_ru_names(ru_names_path).items():
+                g.names[i] = name
+                entries.append((city_key(name), i))
+
+        primary = [
+            (k, i) for i in range(len(g.names))
+            for k in base_keys[i] | {city_key(g.names[i])} if k
+        ]
+        entries = sorted(set(entries))
+        primary.sort()
+        g.keys = [k for k, _ in entries]
+        g.key_ids = array("I", (i for _, i in entries))
+        g.primary_keys = [k for k, _ in primary]
+        g.primary_ids = array("I", (i for _, i in primary))
+        log.info("🗺 Газеттир загружен: %s городов, %s ключей", len(g.names), len(g.keys))
+        return g
+
+    def _load_ru_names(self, path: str) -> dict:
+        """
+        Русские названия из alternateNamesV2 (строки с isolanguage=ru):
+        alternateNameId, geonameid, isolanguage, name, isPreferredName, isShortName, isColloquial, isHistoric.
+        Берём предпочтительное имя, исторические и разговорные пропускаем.
+        """
+        best = {}  # индекс города -> (приоритет, имя)
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) < 4 or cols[2] != "ru":
+                    continue
+                i = self.by_geoname.get(int(cols[1]))
+                flags = cols[4:8] + [""] * (8 - len(cols))
+                if i is None or flags[2] == "1" or flags[3] == "1":
+                    continue
+                rank = 0 if flags[0] == "1" else (2 if flags[1] == "1" else 1)
+                if i not in best or rank < best[i][0]:
+                    best[i] = (rank, cols[3])
+        return {i: name for i, (_, name) in best.items()}
+
+    def _by_population(self, ids, limit: int):
+        return sorted(set(ids), key=lambda i: -self.population[i])[:limit]
+
+    def exact(self, query: str, limit: int = 5):
+        key = city_key(query)
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_right(self.keys, key)
+        return self._by_population(self.key_ids[lo:hi], limit)
+
+    def prefix(self, query: str, limit: int = 5, scan: int = 500):
+        key = city_key(query)
+        if len(key) < 3:
+            return []
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_left(self.keys, key + "\x7f", lo, min(lo + scan, len(self.keys)))
+        return self._by_population(self.key_ids[lo:hi], limit)
+
+    def fuzzy(self, query: str, limit: int = 5, max_dist: int = 2):
+        key = city_key(query)
+        if len(key) < 4:
+            return []
+        # кандидаты — основные ключи на ту же букву
+        lo = bisect.bisect_left(self.primary_keys, key[0])
+        hi = bisect.bisect_left(self.primary_keys, chr(ord(key[0]) + 1))
+        scored = []
+        for k, i in zip(self.primary_keys[lo:hi], self.primary_ids[lo:hi]):
+            d = _edit_distance(key, k, max_dist)
+            if d <= max_dist:
+                scored.append((d, -self.population[i], i))
+        scored.sort()
+        seen, out = set(), []
+        for _, _, i in scored:
+            if i not in seen:
+                seen.add(i)
+                out.append(i)
+            if len(out) >= limit:
+                break
+        return out
+
+    def suggest(self, query: str, limit: int = 3):
+        return self.prefix(query, limit) or self.fuzzy(query, limit)
+
+    def label(self, i: int, detailed: bool = False) -> str:
+        text = f"{self.names[i]}, {self.countries[i]}"
+        if detailed:
+            # для одноимённых городов: население и координаты
+            text += f" · {self.population[i] // 1000} тыс. · {self.lat[i]:.1f}°, {self.lon[i]:.1f}°"
+        return text
+
+    def place(self, i: int):
+        """
+        (lat, lon, display_name, tzname) города.
+        """
+        return float(self.lat[i]), float(self.lon[i]), self.label(i), self.tz_names[self.tz_idx[i]]
+
+def _load_gazetteer():
+    if not os.path.exists(GAZETTEER_PATH):
+        log.warning("🗺 Газеттир %s не найден — города ищем только через геокодер", GAZETTEER_PATH)
+        return None
+    try:
+        return Gazetteer.load(GAZETTEER_PATH, GAZETTEER_RU_NAMES)
+    except Exception:
+        log.exception("Gazetteer load error")
+        return None
+
+# Загружаем до форка воркеров — память индекса общая (copy-on-write)
+gazetteer = _load_gazetteer()
+
+def resolve_city(city: str, geoname_id=None):
+    """
+    Координаты города из газеттира: по выбранному geoname_id или точному совпадению.
+    Возвращает (lat, lon, display_name, tzname) или None.
+    """
+    if not gazetteer:
+        return None
+    if geoname_id and geoname_id in gazetteer.by_geoname:
+        return gazetteer.place(gazetteer.by_geoname[geoname_id])
+    ids = gazetteer.exact(city, limit=1)
+    return gazetteer.place(ids[0]) if ids else None
+
 # =========================
 # 🔭 Астрология: геокодинг, TZ, расчёт карты
 # =========================
@@ -318,13 +1220,15 @@ def geocode_city(city: str):
     except Exception:
         return None
 
-def get_timezone_offset_hours(lat: float, lon: float, dt_naive_local_str: str, fmt="%d.%m.%Y %H:%M"):
+def get_timezone_offset_hours(lat: float, lon: float, dt_naive_local_str: str, fmt="%d.%m.%Y %H:%M", tzname=None):
     """
     Возвращает (смещение_в_часах, tzname) для координат и ЛОКАЛЬНОЙ даты/времени рождения.
     dt_naive_local_str: '20.05.1995 14:30'
+    tzname: таймзона, если уже известна (из газеттира)
     """
-    tf = TimezoneFinder()
-    tzname = tf.timezone_at(lat=lat, lng=lon)
+    if not tzname:
+        tf = TimezoneFinder()
+        tzname = tf.timezone_at(lat=lat, lng=lon)
     if not tzname:
         tzname = "Europe/Moscow"
     tz = pytz.timezone(tzname)
@@ -341,21 +1245,28 @@ def _lon_to_sign(lon_deg: float):
     sign_index = int(lon_deg // 30) % 12
     return SIGN_NAMES[sign_index]
 
-def calculate_chart_ddmmyyyy(city: str, date_str_ddmmyyyy: str, time_str_hhmm: str):
+def calculate_chart_ddmmyyyy(city: str, date_str_ddmmyyyy: str, time_str_hhmm: str, geoname_id=None):
     """
     По городу + дате 'dd.mm.yyyy' + времени 'HH:MM' возвращает словарь:
     планеты (тропически), асцендент, MC, куспиды домов (Плацидус).
     """
-    # 1️⃣ Гео-координаты
-    geo = geocode_city(city)
-    if not geo:
-        lat, lon, display = 55.7558, 37.6173, "Москва, Россия (fallback)"
+    # 1️⃣ Гео-координаты: сначала офлайн-газеттир, потом сетевой геокодер
+    tzname = None
+    geo_fallback = False
+    local = resolve_city(city, geoname_id)
+    if local:
+        lat, lon, display, tzname = local
     else:
-        lat, lon, display = geo
+        geo = geocode_city(city)
+        if not geo:
+            lat, lon, display = 55.7558, 37.6173, "Москва, Россия (fallback)"
+            geo_fallback = True
+        else:
+            lat, lon, display = geo
 
     # 2️⃣ Часовой пояс и локальное время
     dt_local_str = f"{date_str_ddmmyyyy} {time_str_hhmm}"
-    offset_hours, tzname = get_timezone_offset_hours(lat, lon, dt_local_str)
+    offset_hours, tzname = get_timezone_offset_hours(lat, lon, dt_local_str, tzname=tzname)
 
     # 3️⃣ Переводим локальное время рождения в UTC
     dt_local = datetime.strptime(dt_local_str, "%d.%m.%Y %H:%M")
@@ -408,9 +1319,9 @@ def calculate_chart_ddmmyyyy(city: str, date_str_ddmmyyyy: str, time_str_hhmm: s
         }
 
     # 📜 Логи по планетам
-    log.info("✅ Планеты рассчитаны:")
-    for pl_name, pdata in planets.items():
-        log.info(f" - {pl_name}: {pdata['sign']} ({pdata['lon']:.2f}°)")
+    log_chart.info("✅ Планеты рассчитаны: %s", lazy(lambda: ", ".join(
+        f"{pl_name}: {pdata['sign']} ({pdata['lon']:.2f}°)" for pl_name, pdata in planets.items()
+    )))
 
     # 6️⃣ Дома (Плацидус)
     houses, ascmc = swe.houses(jd, lat, lon)
@@ -421,6 +1332,7 @@ def calculate_chart_ddmmyyyy(city: str, date_str_ddmmyyyy: str, time_str_hhmm: s
     # ✅ Возврат результатов
     return {
         "city_resolved": display,
+        "geo_fallback": geo_fallback,  # город не найден/геокодер недоступен — координаты Москвы
         "tzname": tzname,
         "utc_offset_hours": offset_hours,
         "ascendant": {"lon": asc, "sign": asc_sign},
@@ -464,7 +1376,9 @@ async def cmd_help(message: types.Message):
         "✨ <b>Что я умею</b>\n"
         "• Сохраняю твои данные рождения (город, дата, время)\n"
         "• Помогаю разобраться в сферах: Личность, Деньги, Карьера, Отношения, Предназначение\n"
-        "• В каждой сфере: общее описание, прогноз на 5 лет, советы по гармонизации\n\n"
+        "• В каждой сфере: общее описание, прогноз на 5 лет, советы по гармонизации\n"
+        "• /full — полный разбор всех сфер одним документом (для полного доступа)\n"
+        "• /history — твои прошлые разборы, без ожидания\n\n"
         "🔎 После ввода данных жми нужную сферу — и я подготовлю персональный разбор 💫"
     )
     await message.answer(text, reply_markup=help_kb)
@@ -476,10 +1390,69 @@ async def cmd_reset(message: types.Message):
     if not u.get("paid"):
         await message.answer("🔒 Команда доступна только пользователям с полным доступом.")
         return
+    await write_behind.flush()
     delete_history(u["user_id"])  # частичный сброс — только история
     await message.answer("🧹 История очищена ✅")
     await message.answer("Выбери сферу ⤵️", reply_markup=sphere_kb)
 
+@dp.message_handler(commands=["full"])
+async def cmd_full(message: types.Message):
+    db_init()
+    await full_report(message)
+
+@dp.message_handler(commands=["history"])
+async def cmd_history(message: types.Message):
+    db_init()
+    ensure_user(message.from_user.id)
+    await write_behind.flush()  # свежие разборы должны попасть в список
+    text, kb = history_page(message.from_user.id)
+    await message.answer(text, reply_markup=kb)
+
+@dp.message_handler(commands=["export"])
+async def cmd_export(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    db_init()
+    await run_export(message)
+
+@dp.message_handler(commands=["usage"])
+async def cmd_usage(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    db_init()
+    await usage_ledger.flush()
+    args = message.get_args().strip()
+    days = int(args) if args.isdigit() else 7
+    rows = usage_daily_totals(days)
+    if not rows:
+        await message.answer("📈 Данных об использовании пока нет")
+        return
+    lines = [f"📈 <b>Токены и стоимость за {days} дн.</b>"]
+    for day, requests, users, pt, cached, ct, avg_ms, cost in rows:
+        lines.append(
+            f"• {day}: {requests} запросов, {users} польз., вход {pt} (кэш {cached}), "
+            f"выход {ct}, ~{avg_ms / 1000:.1f} с, ${cost:.2f}"
+        )
+    lines.append("\n<b>Сегодня по сферам</b>")
+    for sphere, requests, tokens, cost in usage_by_sphere(datetime.utcnow().date().isoformat()):
+        lines.append(f"• {html.escape(sphere or '—')}: {requests} запросов, {tokens} токенов, ${cost:.2f}")
+    await message.answer("\n".join(lines))
+
+@dp.message_handler(commands=["stats"])
+async def cmd_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    lines = ["📊 <b>OpenAI</b>"]
+    lines += [f"• {k}: {v}" for k, v in sorted(openai_counters.items())] or ["• запросов ещё не было"]
+    for model, b in breakers.items():
+        p95 = model_stats.p95(model)
+        p95_text = f"p95 {p95:.1f} с" if p95 is not None else "p95 —"
+        lines.append(
+            f"• {model}: {p95_text}, ошибок {model_stats.error_rate(model):.0%}, "
+            f"breaker {'открыт' if b.is_open() else 'закрыт'}"
+        )
+    await message.answer("\n".join(lines))
+
 @dp.message_handler(commands=["start", "restart"])
 async def cmd_start(message: types.Message):
     db_init()
@@ -495,6 +1468,12 @@ async def cmd_start(message: types.Message):
 # ---------------------------------
 # Data collection
 # ---------------------------------
+async def _city_accepted(message: types.Message, uid: int):
+    set_state(uid, STATE_WAIT_DATE)
+    log_state.info("📍 STATE_WAIT_DATE установлен для %s", uid, extra={"uid": uid, "stage": "wait_date"})
+
+    await message.answer("Отлично! ✨ Теперь пришли дату рождения <b>дд.мм.гггг</b>\nНапример: 15.07.1995")
+
 @dp.message_handler(lambda m: get_state(m.from_user.id) == STATE_WAIT_CITY)
 async def ask_date(message: types.Message):
     if await try_unlock(message): 
@@ -506,16 +1485,64 @@ async def ask_date(message: types.Message):
         return
 
     u = ensure_user(message.from_user.id)
-    update_user(u["user_id"], city=city)
 
-    set_state(u["user_id"], STATE_WAIT_DATE)
-    log.info(f"📍 STATE_WAIT_DATE установлен для {u['user_id']}")
+    # 🗺 Проверяем город по офлайн-газеттиру
+    if gazetteer:
+        ids = gazetteer.exact(city, 5)
+        if len(ids) == 1:
+            # Название оставляем как ввёл пользователь, запоминаем только geoname_id
+            update_user(u["user_id"], city=city, geoname_id=int(gazetteer.geoname_ids[ids[0]]))
+            await _city_accepted(message, u["user_id"])
+            return
 
-    await message.answer("Отлично! ✨ Теперь пришли дату рождения <b>дд.мм.гггг</b>\nНапример: 15.07.1995")
+        update_user(u["user_id"], city=city, geoname_id=None)
+        if ids:
+            # Одноимённые города — спрашиваем, какой именно
+            kb = InlineKeyboardMarkup(row_width=1)
+            for i in ids:
+                kb.add(InlineKeyboardButton(
+                    text=gazetteer.label(i, detailed=True),
+                    callback_data=f"city:{gazetteer.geoname_ids[i]}:keep"
+                ))
+            await message.answer("Городов с таким названием несколько — какой твой? 🏙️", reply_markup=kb)
+            return
+
+        ids = await asyncio.to_thread(gazetteer.suggest, city, 3)
+        if ids:
+            kb = InlineKeyboardMarkup(row_width=1)
+            for i in ids:
+                kb.add(InlineKeyboardButton(text=gazetteer.label(i), callback_data=f"city:{gazetteer.geoname_ids[i]}"))
+            kb.add(InlineKeyboardButton(text=f"✍️ Оставить «{city[:40]}»", callback_data="city:0"))
+            await message.answer("Не нашла такой город 🤔 Может, ты имела в виду:", reply_markup=kb)
+            return
+    else:
+        update_user(u["user_id"], city=city)
+
+    await _city_accepted(message, u["user_id"])
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("city:"))
+async def pick_city_suggestion(call: types.CallbackQuery):
+    uid = call.from_user.id
+    await call.answer()
+    if get_state(uid) != STATE_WAIT_CITY:
+        return
+    await call.message.edit_reply_markup()
+
+    _, raw_id, *flags = call.data.split(":")
+    geoname_id = int(raw_id)
+    if geoname_id and gazetteer and geoname_id in gazetteer.by_geoname:
+        i = gazetteer.by_geoname[geoname_id]
+        if "keep" in flags:
+            # выбор среди одноимённых — введённое название верное
+            update_user(uid, geoname_id=geoname_id)
+        else:
+            update_user(uid, city=gazetteer.names[i], geoname_id=geoname_id)
+        await call.message.answer(f"📍 {gazetteer.label(i, detailed='keep' in flags)}")
+    await _city_accepted(call.message, uid)
 
 @dp.message_handler(lambda m: get_state(m.from_user.id) == STATE_WAIT_DATE)
 async def ask_time(message: types.Message):
-    log.info(f"📆 Вошёл в ask_time. Текущее состояние: {get_state(message.from_user.id)}")
+    log_state.debug("📆 Вошёл в ask_time", extra={"uid": message.from_user.id, "stage": "wait_date"})
 
     if await try_unlock(message): 
         return
@@ -529,7 +1556,7 @@ async def ask_time(message: types.Message):
     update_user(u["user_id"], birth_date=date)
 
     set_state(u["user_id"], STATE_WAIT_TIME)
-    log.info(f"⏱ STATE_WAIT_TIME установлен для {u['user_id']}")
+    log_state.info("⏱ STATE_WAIT_TIME установлен для %s", u["user_id"], extra={"uid": u["user_id"], "stage": "wait_time"})
 
     await message.answer("Супер! 🕰️ Теперь пришли время рождения <b>чч:мм</b>\nЕсли не знаешь — напиши <i>не знаю</i>")
 
@@ -564,9 +1591,13 @@ async def ready_menu(message: types.Message):
         update_user(u["user_id"], birth_time=t)
 
     set_state(u["user_id"], STATE_READY)
-    log.info(f"✅ Пользователь {u['user_id']} готов, состояние: STATE_READY")
+    log_state.info("✅ Пользователь %s готов, состояние: STATE_READY", u["user_id"], extra={"uid": u["user_id"], "stage": "ready"})
     u = get_user(u["user_id"])
 
+    # 🔮 Пока пользователь выбирает сферу — считаем карту и первый разбор
+    if PREFETCH_ENABLED:
+        spawn(start_speculation(u["user_id"]))
+
     # Вариант 2: сначала резюме, потом меню
     await message.answer(
         "Отлично! Данные сохранены ✅\n\n"
@@ -588,7 +1619,7 @@ async def pick_subtopic(message: types.Message):
     if not await guard_access(message, u):
         return
 
-    user_state[f"last_sphere_{message.from_user.id}"] = message.text
+    set_last_sphere(message.from_user.id, message.text)
     await message.answer(
         f"Ты выбрала: <b>{message.text}</b> 💫\nТеперь выбери формат разбора:",
         reply_markup=sub_kb
@@ -604,59 +1635,70 @@ async def back_to_spheres(message: types.Message):
     await message.answer("Выбери сферу ⤵️", reply_markup=sphere_kb)
 
 # ---------------------------------
-# Final generate (GPT-4)
+# Reading pipeline: карта → промпт → GPT
 # ---------------------------------
-@dp.message_handler(lambda m: get_state(m.from_user.id) == STATE_READY and m.text in SUB_MAP.keys())
-async def final_generate(message: types.Message):
-    # 🔑 Разблокировка кодом (если ввели код вместо кнопки)
-    if await try_unlock(message):
-        return
-
-    uid = message.from_user.id
-    u = ensure_user(uid)
-    if not await guard_access(message, u):
-        return
-
-    # Какая сфера выбрана ранее (сохранялась в pick_subtopic)
-    sphere = user_state.get(f"last_sphere_{uid}")
-    if not sphere:
-        await message.answer("Сначала выбери сферу ⤵️", reply_markup=sphere_kb)
-        return
-
-    # Текущая подтема — это текущий текст сообщения (кнопка из SUB_MAP)
-    sub = message.text
+SYSTEM_PROMPT = (
+    "Ты опытный ведический астролог-консультант (джйотиш) с многолетней практикой. "
+    "Ты анализируешь натальные карты ТОЛЬКО на основе предоставленных данных. "
+    "Никогда не придумывай положения планет, домов или знаков. "
+    "Если чего-то нет в блоке данных — не упоминай это. "
+    "Все выводы должны быть конкретными, связанными с реальными положениями из карты."
+)
 
-    # Профиль пользователя для подстановки в промпт
-    birth = get_user(uid) or {}
-    birth_text = (
+def birth_to_text(birth: dict) -> str:
+    return (
         f"📍 Город: {birth.get('city', '—')}\n"
         f"📅 Дата: {birth.get('birth_date', '—')}\n"
         f"⏰ Время: {birth.get('birth_time', '—')}"
     )
 
-    sphere_text = SPHERE_MAP.get(sphere, sphere)
-    sub_text = SUB_MAP.get(sub, sub)
-
-    # ====== 🪐 АСТРО-КАРТА из введённых данных ======
+def chart_inputs(birth: dict):
+    """
+    (город, дата, время) для расчёта карты с разумными дефолтами.
+    """
     city_for_calc = birth.get("city") or "Москва"
     date_for_calc = birth.get("birth_date") or "01.01.2000"
     time_for_calc = birth.get("birth_time") or "12:00"
     if "неизвест" in time_for_calc.lower():
         time_for_calc = "12:00"  # разумный дефолт при неизвестном времени
+    return city_for_calc, date_for_calc, time_for_calc
+
+def profile_key(birth: dict) -> str:
+    return "|".join(chart_inputs(birth)) + f"|{birth.get('geoname_id') or ''}"
 
+async def get_chart(uid: int, birth: dict) -> dict:
+    """
+    Карта пользователя: из таблицы charts, а если профиль изменился —
+    считаем заново (геокодинг + эфемериды в отдельном потоке) и сохраняем.
+    """
+    key = profile_key(birth)
+    cached = load_chart(uid, key)
+    if cached:
+        return cached
+    chart = await asyncio.to_thread(calculate_chart_ddmmyyyy, *chart_inputs(birth), birth.get("geoname_id"))
+    # Карту с координатами-заглушкой не кэшируем: сбой геокодера может быть временным
+    if not chart.get("geo_fallback"):
+        store_chart(uid, key, chart)
+    return chart
+
+async def get_astro_block(uid: int, birth: dict) -> str:
     try:
-        chart = calculate_chart_ddmmyyyy(city_for_calc, date_for_calc, time_for_calc)
+        chart = await get_chart(uid, birth)
         astro_block = chart_to_text(chart)
         if "Планеты:" not in astro_block or "Дом" not in astro_block:
             log.warning("⚠️ В astro_block нет нужных данных! GPT может сгенерировать общий текст.")
 
-
-        # ✅ Вот здесь вставляем лог, чтобы проверить, что карта реально сформировалась:
-        log.info(f"🪐 AstroBlock:\n{astro_block}")
+        # ✅ Лог, чтобы проверить, что карта реально сформировалась
+        log_astro.info("🪐 AstroBlock:\n%s", astro_block, extra={"uid": uid, "stage": "astro"})
+        return astro_block
 
     except Exception:
         log.exception("Astro calc error")
-        astro_block = "Астрологические расчёты недоступны. Используй общий психологический анализ по данным пользователя."
+        return "Астрологические расчёты недоступны. Используй общий психологический анализ по данным пользователя."
+
+def build_prompt(sphere: str, sub: str, birth_text: str, astro_block: str) -> str:
+    sphere_text = SPHERE_MAP.get(sphere, sphere)
+    sub_text = SUB_MAP.get(sub, sub)
 
     # -----------------------
     # 🔮 Выбираем PROMPT по сфере
@@ -870,44 +1912,598 @@ async def final_generate(message: types.Message):
             "Каждый раздел должен содержать конкретную интерпретацию именно для этого человека на основе его натальной карты.\n"
             "Не используй общих фраз, теоретических описаний или вероятностных выражений вроде «может быть» или «возможно».\n"
             "Пиши так, как если бы ты давал консультацию клиенту лично, анализируя его реальные положения."
-        ) 
+        )
 
-       # -----------------------
-    # 📡 GPT-запрос
-    # -----------------------
+    return prompt
+
+# ---------------------------------
+# Model routing: модель, лимит токенов и таймаут по тарифу/сфере/подтеме
+# ---------------------------------
+MODEL_ROUTES = {
+    "free": {"model": "gpt-4o-mini", "max_tokens": 2000, "timeout": 45},
+    "paid": {"model": "gpt-4o", "max_tokens": 3500, "timeout": 90},
+}
+# Переопределения по (тариф, сфера, подтема); None — любая
+ROUTE_OVERRIDES = {
+    ("paid", None, "🔮 Прогноз на 5 лет"): {"max_tokens": 4000, "timeout": 120},
+    ("paid", None, "🪷 Советы по гармонизации"): {"max_tokens": 2500},
+    ("free", None, "🪷 Советы по гармонизации"): {"max_tokens": 1500},
+}
+# MODEL_ROUTES='{"paid": {"model": "gpt-4.1"}}' — переопределение из env
+for _tier, _cfg in json.loads(os.getenv("MODEL_ROUTES", "{}")).items():
+    MODEL_ROUTES.setdefault(_tier, {}).update(_cfg)
+
+class ModelStats:
+    """
+    Скользящее окно латентности и ошибок по каждой модели.
+    Замеры старше ttl секунд отбрасываются: пока трафик идёт на fallback,
+    у основной модели новых замеров нет, и без этого она не вернулась бы никогда.
+    """
+
+    def __init__(self, window: int = ROUTE_WINDOW, ttl: float = ROUTE_STATS_TTL):
+        self.ttl = ttl
+        self.samples = defaultdict(lambda: deque(maxlen=window))  # (monotonic, latency, ok)
+
+    def record(self, model: str, latency: float, ok: bool):
+        self.samples[model].append((time.monotonic(), latency, ok))
+
+    def _fresh(self, model: str):
+        s = self.samples[model]
+        cutoff = time.monotonic() - self.ttl
+        while s and s[0][0] < cutoff:
+            s.popleft()
+        return s
+
+    def p95(self, model: str):
+        lat = sorted(x[1] for x in self._fresh(model) if x[2])
+        if len(lat) < 10:
+            return None
+        return lat[math.ceil(len(lat) * 0.95) - 1]  # nearest-rank
+
+    def error_rate(self, model: str) -> float:
+        s = self._fresh(model)
+        if len(s) < 10:
+            return 0.0
+        return sum(1 for x in s if not x[2]) / len(s)
+
+model_stats = ModelStats()
+
+def choose_route(tier: str, sphere: str, sub: str, uid=None) -> dict:
+    """
+    Маршрут запроса: {"model", "max_tokens", "timeout"} + поля для журнала токенов.
+    Если у основной модели вырос p95 или доля ошибок — уходим на FALLBACK_MODEL.
+    """
+    route = dict(MODEL_ROUTES.get(tier, MODEL_ROUTES["paid"]))
+    for key in ((tier, None, sub), (tier, sphere, None), (tier, sphere, sub)):
+        route.update(ROUTE_OVERRIDES.get(key, {}))
+
+    reason = "primary"
+    p95 = model_stats.p95(route["model"])
+    err = model_stats.error_rate(route["model"])
+    if route["model"] != FALLBACK_MODEL:
+        if p95 is not None and p95 > ROUTE_P95_THRESHOLD:
+            reason = f"fallback: p95 {p95:.1f}s"
+        elif err > ROUTE_ERROR_RATE_THRESHOLD:
+            reason = f"fallback: errors {err:.0%}"
+        elif breakers[route["model"]].is_open():
+            reason = "fallback: circuit open"
+        if reason != "primary":
+            route["model"] = FALLBACK_MODEL
+
+    log_route.info(
+        "🧭 Route %s / %s [%s] → %s, max_tokens=%s, timeout=%ss (%s)",
+        sphere, sub, tier, route["model"], route["max_tokens"], route["timeout"], reason,
+        extra={"uid": uid, "stage": "route"}
+    )
+    # для журнала токенов; reading_key — общий для всех запросов одного разбора
+    route.update(uid=uid, tier=tier, sphere=sphere, sub=sub, reading_key=uuid.uuid4().hex)
+    return route
+
+def user_tier(u: dict) -> str:
+    return "paid" if u.get("paid") else "free"
+
+# ---------------------------------
+# OpenAI resilience: дедлайны, бэкофф, circuit breaker, хеджирование
+# ---------------------------------
+openai_counters = Counter()  # requests, success, timeout, rate_limited, server_error, ...
+
+class CircuitOpenError(Exception):
+    """
+    Модель временно отключена предохранителем; retry_in — через сколько секунд пробовать.
+    """
+
+    def __init__(self, model: str, retry_in: float):
+        super().__init__(f"Circuit open for {model}, retry in {retry_in:.0f}s")
+        self.model = model
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """
+    После BREAKER_FAILURES неудачных запросов подряд размыкается на BREAKER_COOLDOWN секунд,
+    затем пропускает один пробный запрос (half-open).
+    Сбой — это запрос, исчерпавший повторы (429 не считаются: их гасит retry-after).
+    """
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probing = False
+        self.last_success = 0.0
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_until - time.monotonic())
+
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold and (self.retry_in() > 0 or self.probing)
+
+    def check(self, model: str) -> bool:
+        """
+        Пропускает запрос или бросает CircuitOpenError. True — этот запрос пробный,
+        и вызывающий обязан завершить его через end_probe().
+        """
+        if self.failures < self.threshold:
+            return False
+        if self.retry_in() > 0 or self.probing:
+            openai_counters["breaker_rejected"] += 1
+            raise CircuitOpenError(model, self.retry_in() or self.cooldown)
+        self.probing = True  # half-open: пропускаем один запрос
+        return True
+
+    def end_probe(self):
+        # Пробный запрос завершён любым исходом (в т.ч. 400 или отменой) —
+        # следующий вызов снова сможет стать пробным
+        self.probing = False
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+        self.last_success = time.monotonic()
+
+    def failure(self, started: float):
+        if started < self.last_success and not self.probing:
+            return  # запрос начался до последнего успеха — модель уже ожила
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if not self.probing:
+                openai_counters["breaker_open"] += 1
+                log.warning("🔌 Circuit breaker разомкнут на %.0f с", self.cooldown)
+            self.opened_until = time.monotonic() + self.cooldown
+        self.probing = False
+
+breakers = defaultdict(CircuitBreaker)  # model -> CircuitBreaker
+
+_rate_limit = {"until": 0.0}  # общая пауза после 429 для всех параллельных запросов
+
+def _retry_after(exc):
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def _classify_error(exc):
+    """
+    Тип сбоя для счётчиков и повторов; None — ошибка не временная, повторять нельзя.
+    """
+    if isinstance(exc, (asyncio.TimeoutError, APITimeoutError)):
+        return "timeout"
+    if isinstance(exc, RateLimitError):
+        return "rate_limited"
+    if isinstance(exc, APIStatusError) and exc.status_code >= 500:
+        return "server_error"
+    if isinstance(exc, APIConnectionError):
+        return "connection_error"
+    return None
+
+async def _hedged(call, hedge_after, on_loser=None):
+    """
+    Запускает call(); если он не уложился в hedge_after секунд — параллельно
+    второй такой же. Возвращает первый успешный результат.
+    Проигравший запрос не отменяем, если задан on_loser: токены за него всё равно
+    списываются, поэтому дожидаемся его в фоне и отдаём результат в on_loser.
+    """
+    def loser_done(t):
+        _spawned.discard(t)
+        if not t.cancelled() and t.exception() is None:
+            on_loser(*t.result())
+
+    first = asyncio.create_task(call())
+    tasks = {first}
+    winner = None
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Ты опытный ведический астролог-консультант (джйотиш) с многолетней практикой. "
-                        "Ты анализируешь натальные карты ТОЛЬКО на основе предоставленных данных. "
-                        "Никогда не придумывай положения планет, домов или знаков. "
-                        "Если чего-то нет в блоке данных — не упоминай это. "
-                        "Все выводы должны быть конкретными, связанными с реальными положениями из карты."
-                    )
-                },
-                {"role": "user", "content": prompt},
-            ]
+        if hedge_after is not None:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                openai_counters["hedged"] += 1
+                tasks.add(asyncio.create_task(call()))
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is not first:
+                        openai_counters["hedge_won"] += 1
+                    winner = t
+                    return t.result()
+                error = t.exception()
+        raise error
+    finally:
+        for t in tasks:
+            if t.done():
+                continue
+            if winner is not None and on_loser is not None:
+                _spawned.add(t)
+                t.add_done_callback(loser_done)
+            else:
+                t.cancel()
+
+# ---------------------------------
+# Usage ledger: токены и стоимость по пользователям и сферам
+# ---------------------------------
+# $ за 1M токенов: (вход, вход из кэша, выход)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+def usage_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    price_in, price_cached, price_out = MODEL_PRICES.get(model, (0.0, 0.0, 0.0))
+    return (
+        (prompt_tokens - cached_tokens) * price_in
+        + cached_tokens * price_cached
+        + completion_tokens * price_out
+    ) / 1_000_000
+
+class UsageLedger(BatchWriter):
+    """
+    Копит записи об использовании токенов в памяти и пишет их в базу пачками
+    раз в USAGE_FLUSH_INTERVAL секунд или при USAGE_FLUSH_SIZE записях — вне пути ответа.
+    """
+
+    name = "Usage ledger"
+
+    def __init__(self):
+        super().__init__(USAGE_FLUSH_INTERVAL, USAGE_FLUSH_SIZE)
+        self.buffer = []
+
+    def record(self, route: dict, model: str, usage, latency: float, hedge_loser: bool = False):
+        if usage is None:
+            return
+        prompt_tokens = usage.prompt_tokens or 0
+        completion_tokens = usage.completion_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        self.buffer.append((
+            datetime.utcnow().isoformat(), route.get("uid"), route.get("tier"),
+            route.get("sphere"), route.get("sub"), model,
+            prompt_tokens, cached_tokens, completion_tokens, round(latency * 1000),
+            usage_cost(model, prompt_tokens, cached_tokens, completion_tokens),
+            route.get("reading_key"), int(hedge_loser),
+        ))
+        self._changed()
+
+    def _size(self) -> int:
+        return len(self.buffer)
+
+    def _take(self):
+        batch, self.buffer = self.buffer, []
+        return batch
+
+    def _write(self, batch):
+        write_usage(batch)
+
+    def _requeue(self, batch):
+        self.buffer = batch + self.buffer
+
+usage_ledger = UsageLedger()
+
+async def generate_answer(prompt: str, route: dict) -> str:
+    model = route["model"]
+    breaker = breakers[model]
+    started = time.monotonic()
+
+    async def attempt_call():
+        started = time.monotonic()
+        openai_counters["requests"] += 1
+        try:
+            completion = await asyncio.wait_for(
+                client.chat.completions.create(
+                    model=model,
+                    max_tokens=route["max_tokens"],
+                    timeout=route["timeout"],
+                    messages=[
+                        {"role": "system", "content": SYSTEM_PROMPT},
+                        {"role": "user", "content": prompt},
+                    ]
+                ),
+                timeout=route["timeout"],
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            model_stats.record(model, time.monotonic() - started, ok=False)
+            raise
+        latency = time.monotonic() - started
+        model_stats.record(model, latency, ok=True)
+        log_route.info(
+            "⏱ %s: %.1f с", model, latency,
+            extra={"stage": "openai", "duration_ms": round(latency * 1000)}
         )
+        return completion, latency
+
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        probe = breaker.check(model)
+        try:
+            pause = _rate_limit["until"] - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            hedge_after = model_stats.p95(model) if HEDGE_ENABLED else None
+            completion, latency = await _hedged(
+                attempt_call, hedge_after,
+                lambda c, lat: usage_ledger.record(route, model, c.usage, lat, hedge_loser=True)
+            )
+        except Exception as e:
+            kind = _classify_error(e)
+            openai_counters[kind or "error"] += 1
+            if kind is None:
+                raise
+            # В предохранитель — один сбой на запрос после всех повторов
+            # (пробный — сразу), и не 429
+            if kind != "rate_limited" and (probe or attempt == OPENAI_MAX_RETRIES):
+                breaker.failure(started)
+            if attempt == OPENAI_MAX_RETRIES:
+                raise
+            error = e
+        else:
+            breaker.success()
+            openai_counters["success"] += 1
+            usage_ledger.record(route, model, completion.usage, latency)
+            break
+        finally:
+            if probe:
+                breaker.end_probe()
+
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            # экспоненциальный бэкофф с джиттером
+            cap = min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt)
+            delay = random.uniform(cap / 2, cap)
+        if kind == "rate_limited":
+            _rate_limit["until"] = max(_rate_limit["until"], time.monotonic() + delay)
+        openai_counters["retries"] += 1
+        log.warning("⏳ OpenAI %s, повтор через %.1f с (попытка %s)", kind, delay, attempt + 1)
+        await asyncio.sleep(delay)
+
+    raw_answer = completion.choices[0].message.content if completion.choices else ""
+    if not raw_answer:
+        raise ValueError("❌ GPT не вернул текст ответа")
+
+    # ✅ Преобразуем и форматируем ответ
+    return format_answer(raw_answer)
+
+async def make_reading(uid: int, sphere: str, sub: str, birth: dict):
+    """
+    Полный цикл генерации разбора. Возвращает (prompt, answer, reading_key).
+    """
+    astro_block = await get_astro_block(uid, birth)
+    prompt = build_prompt(sphere, sub, birth_to_text(birth), astro_block)
+    route = choose_route(user_tier(birth), sphere, sub, uid)
+    answer = await generate_answer(prompt, route)
+    return prompt, answer, route["reading_key"]
+
+async def send_answer(message: types.Message, answer: str):
+    # 🔧 Разбиваем длинный текст на части и отправляем по кускам
+    MAX_LEN = 4000
+    for i in range(0, len(answer), MAX_LEN):
+        await message.answer(answer[i:i + MAX_LEN])
 
-        raw_answer = completion.choices[0].message.content if completion.choices else ""
-        if not raw_answer:
-            raise ValueError("❌ GPT не вернул текст ответа")
+# ---------------------------------
+# Sectioned generation: разделы main_topics параллельно
+# ---------------------------------
+def build_section_base(sphere: str, sub: str, birth_text: str, astro_block: str) -> str:
+    """
+    Общая часть промпта для разбора по разделам. В отличие от build_prompt,
+    здесь нет структуры и объёма всего разбора — раздел задаёт section_prompt.
+    """
+    return (
+        "⚠️ ВАЖНО: Ты анализируешь только те положения, которые указаны в блоке астрологических данных. "
+        "Никогда не придумывай знаки, дома или аспекты, если их нет в этих данных. "
+        "Если данных о планете нет — просто не анализируй её.\n\n"
+        "Ты — опытный ведический астролог-консультант (джйотиш), делающий глубокие персональные разборы. "
+        "Разбор готовится по разделам: в каждом ответе ты пишешь ровно один раздел, который тебе укажут.\n\n"
+        "📌 Формат и стиль:\n"
+        "- Пиши глубоко и конкретно, с уважительным, тёплым тоном.\n"
+        "- Используй термины ведической астрологии, но поясняй их простыми словами.\n"
+        "- Эмодзи — не больше 1–2 на раздел.\n"
+        "- Заверши раздел практическими рекомендациями (ритуалы, мантры, дни недели, привычки и т.д.).\n"
+        "- Избегай фатализма. Всегда подчёркивай свободу воли и потенциал для роста.\n\n"
+        "📜 Исходные данные:\n"
+        f"{birth_text}\n\n"
+        "📊 Индивидуальные астрологические данные:\n"
+        f"{astro_block}\n\n"
+        f"Сфера анализа: {SPHERE_MAP.get(sphere, sphere)}\n"
+        f"Подтема: {SUB_MAP.get(sub, sub)}\n\n"
+        "Используй исключительно данные из блока «📊 Индивидуальные астрологические данные»: "
+        "указывай, в каком знаке стоит планета, какие дома активны, как их управители влияют на сферу жизни.\n"
+        "Не используй общие формулировки и не пиши, что данных не хватает.\n"
+        "Не используй форматирование с ** или ###, пиши простыми абзацами.\n"
+        "Не используй вероятностных выражений вроде «может быть» или «возможно»."
+    )
 
-        # ✅ Преобразуем и форматируем ответ
-        answer = format_answer(raw_answer)
+def section_prompt(base_prompt: str, heading: str, n: int, total: int) -> str:
+    # Общий префикс одинаков для всех разделов — провайдер кэширует его
+    return (
+        f"{base_prompt}\n\n"
+        f"🎯 Сейчас напиши ТОЛЬКО раздел {n} из {total}: «{heading}».\n"
+        "Объём раздела — 700–1000 символов, с конкретными выводами по карте и практическими советами.\n"
+        "Не пиши вступление, итог всего разбора и другие разделы. "
+        "Не повторяй название раздела — заголовок будет добавлен автоматически."
+    )
+
+async def generate_section(prompt: str, route: dict) -> str:
+    # Один повтор раздела: внутри generate_answer уже исчерпаны быстрые повторы.
+    # ValueError — модель вернула пустой ответ
+    try:
+        return await generate_answer(prompt, route)
+    except (OpenAIError, asyncio.TimeoutError, ValueError):
+        log.warning("Раздел не получился, пробую ещё раз", extra={"uid": route.get("uid"), "stage": "section"})
+        return await generate_answer(prompt, route)
+
+async def stream_sectioned_reading(message: types.Message, uid: int, sphere: str, sub: str, birth: dict):
+    """
+    Все разделы сферы генерируются параллельно, а отправляются по порядку —
+    каждый, как только готовы он и все предыдущие. Возвращает (prompt, answer, reading_key):
+    у всех разделов один reading_key, в журнале токенов они — один разбор.
+    Если раздел не получился и после повтора, возвращаются уже отправленные разделы:
+    их сохраняем и засчитываем как разбор. Если не вышел даже первый — ошибка.
+    """
+    astro_block = await get_astro_block(uid, birth)
+    base_prompt = build_section_base(sphere, sub, birth_to_text(birth), astro_block)
+    route = choose_route(user_tier(birth), sphere, sub, uid)
+    headings = main_topics[sphere]
+    # Бюджет маршрута — на весь разбор, поэтому делим его между разделами
+    route["max_tokens"] = min(route["max_tokens"] // len(headings), SECTION_MAX_TOKENS)
+
+    tasks = [
+        asyncio.create_task(generate_section(section_prompt(base_prompt, h, n, len(headings)), route))
+        for n, h in enumerate(headings, 1)
+    ]
+    parts = []
+    try:
+        for heading, task in zip(headings, tasks):
+            try:
+                text = await task
+            except (CircuitOpenError, OpenAIError, asyncio.TimeoutError, ValueError):
+                if not parts:
+                    raise
+                log.exception("Section error", extra={"uid": uid, "stage": "section"})
+                await message.answer(
+                    f"⚠️ Разделы с «{heading}» сейчас не получились — "
+                    "сохранила то, что уже пришло. Попробуй эту подтему чуть позже."
+                )
+                break
+            part = f"✨ {heading}\n\n{text}"
+            await send_answer(message, part)
+            parts.append(part)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return base_prompt, "\n\n".join(parts), route["reading_key"]
+
+# ---------------------------------
+# Speculative prefetch: самый вероятный первый разбор
+# ---------------------------------
+_prefetch_tasks = {}  # (uid, sphere, sub) -> asyncio.Task
+_popular_pair = {"at": None, "pair": None}
+
+async def most_requested_pair():
+    """
+    Самая популярная пара (сфера, подтема) по истории readings; кэшируется на 10 минут.
+    """
+    now = datetime.utcnow()
+    if _popular_pair["at"] and now - _popular_pair["at"] < timedelta(minutes=10):
+        return _popular_pair["pair"]
+    pair = await asyncio.to_thread(popular_reading_pair)
+    if not pair or pair[0] not in SPHERE_MAP or pair[1] not in SUB_MAP:
+        pair = ("🧬 Личность", "📖 Общее описание")
+    _popular_pair.update(at=now, pair=pair)
+    return pair
+
+async def _prefetch_reading(uid: int, sphere: str, sub: str, birth: dict):
+    try:
+        prompt, answer, reading_key = await make_reading(uid, sphere, sub, birth)
+        store_prefetch(uid, sphere, sub, profile_key(birth), prompt, answer, reading_key)
+        log.info("🔮 Prefetch готов: %s / %s", sphere, sub, extra={"uid": uid, "stage": "prefetch"})
+    except Exception:
+        log.exception("Prefetch error")
+    finally:
+        _prefetch_tasks.pop((uid, sphere, sub), None)
 
-        # 🔧 Разбиваем длинный текст на части и отправляем по кускам
-        MAX_LEN = 4000
-        for i in range(0, len(answer), MAX_LEN):
-            part = answer[i:i + MAX_LEN]
-            await message.answer(part)
+async def start_speculation(uid: int):
+    """
+    Вызывается, когда профиль заполнен: считаем и сохраняем карту,
+    а оплатившим заранее генерируем самый вероятный разбор.
+    """
+    if not PREFETCH_ENABLED:
+        return
+    u = get_user(uid) or {}
+    try:
+        chart = await get_chart(uid, u)
+    except Exception:
+        log.exception("Prefetch chart error")
+        return
+    if not u.get("paid") or chart.get("geo_fallback"):
+        return
+    sphere, sub = await most_requested_pair()
+    key = (uid, sphere, sub)
+    if key in _prefetch_tasks or has_prefetch(uid, sphere, sub, profile_key(u)):
+        return
+    if not take_prefetch_budget(datetime.utcnow().date().isoformat(), PREFETCH_DAILY_BUDGET):
+        log.info("🔮 Бюджет prefetch на сегодня исчерпан")
+        return
+    _prefetch_tasks[key] = asyncio.create_task(_prefetch_reading(uid, sphere, sub, u))
+
+async def take_prefetched(uid: int, sphere: str, sub: str, birth: dict):
+    """
+    Готовый разбор из prefetch (дожидается генерации, если она ещё идёт).
+    Возвращает (prompt, answer, reading_key) или None.
+    """
+    task = _prefetch_tasks.get((uid, sphere, sub))
+    if task:
+        await asyncio.shield(task)
+    return pop_prefetch(uid, sphere, sub, profile_key(birth))
+
+# ---------------------------------
+# Final generate (GPT-4)
+# ---------------------------------
+@dp.message_handler(lambda m: get_state(m.from_user.id) == STATE_READY and m.text in SUB_MAP.keys())
+async def final_generate(message: types.Message):
+    # 🔑 Разблокировка кодом (если ввели код вместо кнопки)
+    if await try_unlock(message):
+        return
+
+    uid = message.from_user.id
+    u = ensure_user(uid)
+    if not await guard_access(message, u):
+        return
+
+    # Какая сфера выбрана ранее (сохранялась в pick_subtopic)
+    sphere = get_last_sphere(uid)
+    if not sphere:
+        await message.answer("Сначала выбери сферу ⤵️", reply_markup=sphere_kb)
+        return
+
+    # Текущая подтема — это текущий текст сообщения (кнопка из SUB_MAP)
+    sub = message.text
+
+    # Профиль пользователя для подстановки в промпт
+    birth = get_user(uid) or {}
+    started = time.monotonic()
+
+    try:
+        ready = await take_prefetched(uid, sphere, sub, birth)
+        if ready:
+            log.info("🔮 Разбор выдан из prefetch", extra={"uid": uid, "stage": "prefetch"})
+            prompt, answer, reading_key = ready
+            await send_answer(message, answer)
+        elif SECTIONED_READINGS and sphere in main_topics:
+            prompt, answer, reading_key = await stream_sectioned_reading(message, uid, sphere, sub, birth)
+        else:
+            prompt, answer, reading_key = await make_reading(uid, sphere, sub, birth)
+            await send_answer(message, answer)
+        log.info(
+            "📨 Разбор отправлен: %s / %s", sphere, sub,
+            extra={"uid": uid, "stage": "reading", "duration_ms": round((time.monotonic() - started) * 1000)}
+        )
 
         # 💾 Сохраняем полный ответ в базу
-        save_reading(uid, sphere, sub, prompt, answer)
+        save_reading(uid, sphere, sub, prompt, answer, reading_key)
 
         # 🔓 Отмечаем использование бесплатной версии
         if not u.get("paid") and not u.get("free_used"):
@@ -917,35 +2513,543 @@ async def final_generate(message: types.Message):
                 "Чтобы открыть все разделы — введи секретный код разблокировки."
             )
 
-    except OpenAIError:
-        log.exception("OpenAI error")
+    except CircuitOpenError as e:
+        log.warning("🔌 %s", e, extra={"uid": uid})
+        await message.answer(
+            f"⚠️ ИИ сейчас перегружен. Попробуй снова примерно через {max(1, round(e.retry_in / 60))} мин."
+        )
+
+    except (OpenAIError, asyncio.TimeoutError):
+        log.exception("OpenAI error", extra={"uid": uid, "stage": "generate"})
         await message.answer("⚠️ Сейчас ИИ недоступен. Давай попробуем позже.")
 
     except Exception:
-        log.exception("Unexpected error")
+        log.exception("Unexpected error", extra={"uid": uid, "stage": "generate"})
         await message.answer("❌ Что-то пошло не так. Попробуем ещё раз.")
 
+# ---------------------------------
+# Full report: все сферы × подтемы параллельно
+# ---------------------------------
+def render_full_report(birth: dict, results) -> bytes:
+    """
+    HTML-документ с полным разбором. results: [(sphere, sub, answer | None)].
+    """
+    parts = [
+        "<!DOCTYPE html><html lang=\"ru\"><head><meta charset=\"utf-8\">",
+        "<title>Полный астрологический разбор</title></head><body>",
+        "<h1>Полный астрологический разбор</h1>",
+        f"<p>{html.escape(birth_to_text(birth)).replace(chr(10), '<br>')}</p>",
+    ]
+    current_sphere = None
+    for sphere, sub, answer in results:
+        if sphere != current_sphere:
+            parts.append(f"<h2>{html.escape(sphere)}</h2>")
+            current_sphere = sphere
+        parts.append(f"<h3>{html.escape(sub)}</h3>")
+        if answer is None:
+            parts.append("<p><i>Этот раздел не удалось подготовить — запроси его отдельно.</i></p>")
+            continue
+        for para in answer.split("\n\n"):
+            parts.append(f"<p>{html.escape(para).replace(chr(10), '<br>')}</p>")
+    parts.append("</body></html>")
+    return "\n".join(parts).encode("utf-8")
+
+@dp.message_handler(lambda m: get_state(m.from_user.id) == STATE_READY and m.text == FULL_REPORT_BUTTON)
+async def full_report(message: types.Message):
+    uid = message.from_user.id
+    u = ensure_user(uid)
+    if not u.get("paid"):
+        await message.answer("🔒 Полный разбор доступен только пользователям с полным доступом.")
+        return
+    if get_state(uid) != STATE_READY:
+        await message.answer("Сначала заполни данные рождения — /start")
+        return
+
+    birth = get_user(uid) or {}
+    birth_text = birth_to_text(birth)
+    # Карта считается один раз на все 15 разборов
+    astro_block = await get_astro_block(uid, birth)
+
+    pairs = [(sphere, sub) for sphere in SPHERE_MAP for sub in SUB_MAP]
+    total = len(pairs)
+    status = await message.answer(f"⏳ Готовлю полный разбор: 0/{total}")
+    sem = asyncio.Semaphore(FULL_REPORT_CONCURRENCY)
+    done = 0
+
+    async def one(sphere, sub):
+        nonlocal done
+        prompt = build_prompt(sphere, sub, birth_text, astro_block)
+        route = choose_route("paid", sphere, sub, uid)
+        async with sem:
+            try:
+                answer = await generate_answer(prompt, route)
+            except Exception:
+                log.exception("Full report error: %s / %s", sphere, sub, extra={"uid": uid, "stage": "full_report"})
+                answer = None
+        done += 1
+        try:
+            await status.edit_text(f"⏳ Готовлю полный разбор: {done}/{total}")
+        except Exception:
+            pass  # прогресс — не критично (например, флуд-контроль Telegram)
+        return sphere, sub, prompt, answer, route["reading_key"]
+
+    results = await asyncio.gather(*(one(sphere, sub) for sphere, sub in pairs))
+
+    ok = [r for r in results if r[3] is not None]
+    if not ok:
+        await message.answer("⚠️ Сейчас ИИ недоступен. Давай попробуем позже.")
+        return
+
+    for sphere, sub, prompt, answer, reading_key in ok:
+        save_reading(uid, sphere, sub, prompt, answer, reading_key)
+
+    report = render_full_report(birth, [(sphere, sub, answer) for sphere, sub, _, answer, _ in results])
+    await message.answer_document(
+        types.InputFile(io.BytesIO(report), filename="astro_full_report.html"),
+        caption=f"📚 Полный разбор готов: {len(ok)}/{total} разделов ✨"
+    )
+
+# ---------------------------------
+# History: /history с постраничным просмотром
+# ---------------------------------
+def history_page(uid: int, cursor=None):
+    """
+    Текст и клавиатура страницы истории. cursor — (created_at, id) или None.
+    """
+    rows = readings_page(uid, cursor)
+    if not rows:
+        if cursor:
+            return "Больше разборов нет 🌙", InlineKeyboardMarkup().add(
+                InlineKeyboardButton(text="⬅️ В начало", callback_data="hist:p:")
+            )
+        return "📜 История пока пуста — выбери сферу, и я подготовлю первый разбор ✨", None
+
+    has_more = len(rows) > HISTORY_PAGE_SIZE
+    rows = rows[:HISTORY_PAGE_SIZE]
+    lines = ["📜 <b>Твои разборы</b>\n"]
+    kb = InlineKeyboardMarkup(row_width=1)
+    for n, (rid, sphere, sub, created_at, preview) in enumerate(rows, 1):
+        day = created_at[:10]
+        snippet = " ".join((preview or "").split())
+        lines.append(f"{n}. <b>{html.escape(sphere)}</b> · {html.escape(sub)} · {day}\n<i>{html.escape(snippet)}…</i>\n")
+        kb.add(InlineKeyboardButton(text=f"{n}. {sphere} · {sub}", callback_data=f"hist:r:{rid}"))
+
+    nav = []
+    if cursor:
+        nav.append(InlineKeyboardButton(text="⬅️ В начало", callback_data="hist:p:"))
+    if has_more:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton(text="Дальше ➡️", callback_data=f"hist:p:{last[3]}|{last[0]}"))
+    if nav:
+        kb.row(*nav)
+    return "\n".join(lines), kb
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("hist:p:"))
+async def history_more(call: types.CallbackQuery):
+    await call.answer()
+    await write_behind.flush()
+    raw = call.data[len("hist:p:"):]
+    cursor = None
+    if raw:
+        created_at, rid = raw.rsplit("|", 1)
+        cursor = (created_at, int(rid))
+    text, kb = history_page(call.from_user.id, cursor)
+    await call.message.edit_text(text, reply_markup=kb)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("hist:r:"))
+async def history_show(call: types.CallbackQuery):
+    await call.answer()
+    await write_behind.flush()
+    row = get_reading(call.from_user.id, int(call.data[len("hist:r:"):]))
+    if not row:
+        await call.message.answer("Этот разбор уже удалён 🧹")
+        return
+    sphere, sub, created_at, answer = row
+    await call.message.answer(f"📖 <b>{html.escape(sphere)}</b> · {html.escape(sub)} · {created_at[:10]}")
+    # Сохранённый ответ — без повторного запроса к модели
+    await send_answer(call.message, answer)
+
+# ---------------------------------
+# Admin export: users / readings в CSV или JSONL
+# ---------------------------------
+EXPORT_USAGE = (
+    "Использование: <code>/export users|readings [csv|jsonl] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [new]</code>\n"
+    "<code>new</code> — только то, что появилось или изменилось после прошлой выгрузки с <code>new</code>.\n"
+    "Больших выгрузок Telegram не пропустит (50 МБ) — для них: <code>python main.py export …</code>"
+)
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит Telegram на файл от бота
+
+def parse_export_args(args: list):
+    """
+    users|readings [csv|jsonl] [с] ГГГГ-ММ-ДД [по] ГГГГ-ММ-ДД [new] -> dict или None.
+    «по» включительно: until — следующий день.
+    """
+    if not args or args[0] not in EXPORT_TABLES:
+        return None
+    opts = {"table": args[0], "fmt": "csv", "incremental": False, "since": None, "until": None}
+    slot = None
+    for a in args[1:]:
+        if a in ("csv", "jsonl"):
+            opts["fmt"] = a
+        elif a == "new":
+            opts["incremental"] = True
+        elif a in ("с", "по"):
+            slot = "since" if a == "с" else "until"
+        else:
+            try:
+                day = datetime.strptime(a, "%Y-%m-%d").date()
+            except ValueError:
+                return None
+            if slot is None:
+                slot = "until" if opts["since"] else "since"
+            opts[slot] = (day + timedelta(days=1) if slot == "until" else day).isoformat()
+            slot = None
+    return opts
+
+def write_export(table: str, fmt: str, path: str, since=None, until=None, after=None):
+    """
+    Потоково пишет выгрузку в gzip-файл. Возвращает (число строк, курсор последней строки).
+    """
+    key, ts, cols = EXPORT_TABLES[table]
+    ts_i, key_i = cols.index(ts), cols.index(key)
+    count, last = 0, None
+    with gzip.open(path, "wt", encoding="utf-8", newline="") as f:
+        writer = None
+        if fmt == "csv":
+            writer = csv.writer(f)
+            writer.writerow(cols)
+        for row in export_rows(table, since, until, after):
+            if writer:
+                writer.writerow(row)
+            else:
+                f.write(json.dumps(dict(zip(cols, row)), ensure_ascii=False) + "\n")
+            count += 1
+            last = (row[ts_i], row[key_i])
+    return count, last
+
+async def run_export(message: types.Message):
+    opts = parse_export_args(message.get_args().split())
+    if not opts:
+        await message.answer(EXPORT_USAGE)
+        return
+    table, fmt = opts["table"], opts["fmt"]
+    after = get_export_cursor(export_cursor_name(table)) if opts["incremental"] else None
+
+    await message.answer(f"⏳ Выгружаю {table}…")
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        # Пишем в отдельном потоке — event loop бота не блокируется
+        count, last = await asyncio.to_thread(
+            write_export, table, fmt, path, opts["since"], opts["until"], after
+        )
+        if not count:
+            await message.answer("Новых строк нет 🌙")
+            return
+        if os.path.getsize(path) > EXPORT_MAX_BYTES:
+            # курсор не двигаем — выгрузку можно повторить из консоли
+            await message.answer(
+                f"📦 {table}: {count} строк — файл больше 50 МБ, Telegram его не примет.\n"
+                f"Выгрузи на сервере: <code>python main.py export {html.escape(' '.join(message.get_args().split()))}</code>"
+            )
+            return
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M")
+        await message.answer_document(
+            types.InputFile(path, filename=f"{table}-{stamp}.{fmt}.gz"),
+            caption=f"📦 {table}: {count} строк"
+        )
+        if opts["incremental"]:
+            set_export_cursor(export_cursor_name(table), last)
+    finally:
+        os.remove(path)
+
+def export_cli(argv: list) -> int:
+    """
+    python main.py export users|readings [csv|jsonl] [с …] [по …] [new] [-o файл]
+    Пишет выгрузку на диск без Telegram и без токенов.
+    """
+    path = None
+    if "-o" in argv:
+        i = argv.index("-o")
+        path = argv[i + 1] if i + 1 < len(argv) else None
+        argv = argv[:i] + argv[i + 2:]
+        if not path:
+            print("-o: не указан файл", file=sys.stderr)
+            return 2
+    opts = parse_export_args(argv)
+    if not opts:
+        usage = "\n".join(EXPORT_USAGE.split("\n")[:2]).replace("/export", "python main.py export")
+        print(re.sub(r"</?code>", "", usage), file=sys.stderr)
+        return 2
+    db_init()
+    table, fmt = opts["table"], opts["fmt"]
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M")
+    path = path or f"{table}-{stamp}.{fmt}.gz"
+    after = get_export_cursor(export_cursor_name(table)) if opts["incremental"] else None
+    count, last = write_export(table, fmt, path, opts["since"], opts["until"], after)
+    if count and opts["incremental"]:
+        set_export_cursor(export_cursor_name(table), last)
+    print(f"{table}: {count} строк -> {path}")
+    return 0
+
 # ----------------------
 # Webhook lifecycle
 # ----------------------
 async def on_startup(dp):
     db_init()  # ✅ Инициализация базы данных, если используешь её
-    await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
-    log.info(f"✅ Webhook успешно установлен: {WEBHOOK_URL}")
+    # Повторы отсекает seen_updates, поэтому накопившиеся апдейты не выбрасываем
+    await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=False)
+    log.info("✅ Webhook успешно установлен: %s", WEBHOOK_URL)
 
 async def on_shutdown(dp):
+    # Гарантированно сбрасываем отложенные записи в базу
+    await stop_background()
     await bot.delete_webhook()
     log.info("🧹 Webhook удалён (бот остановлен)")
 
+# ----------------------
+# Роутинг и обработка апдейтов
+# ----------------------
+def update_user_id(data: dict):
+    """
+    user_id отправителя апдейта (message, callback_query, ...) или None.
+    """
+    for value in data.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+def route_worker(data: dict, workers: int) -> int:
+    """
+    Номер воркера для апдейта: все сообщения одного пользователя
+    обрабатывает один и тот же процесс, по порядку.
+    """
+    uid = update_user_id(data)
+    key = uid if uid is not None else data.get("update_id", 0)
+    return key % workers
+
+_user_locks = {}  # uid -> [asyncio.Lock, число ожидающих]
+
+async def process_update_serial(data: dict):
+    """
+    Обрабатывает апдейт, сохраняя порядок сообщений одного пользователя.
+    """
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    uid = update_user_id(data)
+    entry = _user_locks.setdefault(uid, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            # состояние — свежее из sessions: его мог сменить другой воркер или инстанс
+            user_state.pop(uid, None)
+            try:
+                await dp.process_update(types.Update(**data))
+            finally:
+                user_state.pop(uid, None)
+    except Exception:
+        log.exception("Update processing error")
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _user_locks.pop(uid, None)
+
+class UpdateProcessor:
+    """
+    Ограниченная очередь апдейтов + пул фоновых обработчиков.
+    Вебхук отвечает Telegram сразу, а генерация идёт здесь.
+    """
+
+    def __init__(self, maxsize: int = UPDATE_QUEUE_SIZE, concurrency: int = UPDATE_CONCURRENCY):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.concurrency = concurrency
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+
+    def put_nowait(self, data: dict) -> bool:
+        try:
+            self.queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def put(self, data: dict):
+        await self.queue.put(data)
+
+    async def _consume(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                await process_update_serial(data)
+            finally:
+                self.queue.task_done()
+
+    async def stop(self):
+        # Дорабатываем всё, что уже приняли
+        await self.queue.join()
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+async def start_background():
+    """
+    Фоновые задачи процесса, который обрабатывает апдейты.
+    """
+    write_behind.start()
+    usage_ledger.start()
+
+async def stop_background():
+    await usage_ledger.stop()
+    await write_behind.stop()
+
+async def _close_bot_session():
+    session = await bot.get_session()
+    if session:
+        await session.close()
+
+async def _worker_loop(idx: int, mp_queue):
+    db_init()
+    loop = asyncio.get_running_loop()
+    processor = UpdateProcessor()
+    processor.start()
+    await start_background()
+    log.info("👷 Воркер %s запущен (pid %s)", idx, os.getpid())
+    try:
+        while True:
+            data = await loop.run_in_executor(None, mp_queue.get)
+            if data is None:
+                break
+            await processor.put(data)
+        await processor.stop()
+    finally:
+        # буферы write-behind и журнала токенов сбрасываем при любом выходе
+        await stop_background()
+        await _close_bot_session()
+    log.info("👷 Воркер %s остановлен", idx)
+
+def _worker_main(idx: int, mp_queue):
+    # Останавливает воркеры мастер — через None в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    listener = setup_logging()
+    try:
+        asyncio.run(_worker_loop(idx, mp_queue))
+    finally:
+        # multiprocessing завершает дочерний процесс через os._exit — atexit не сработает,
+        # поэтому дописываем очередь логов явно
+        listener.stop()
+
+def run_webhook(workers: int = 1):
+    """
+    Вебхук с быстрым ответом: апдейт проверяется на повтор по update_id,
+    кладётся в очередь и Telegram сразу получает 200.
+    При workers > 1 апдейты раздаются процессам по хэшу from_user.id.
+    """
+    processor = None
+    watchdog_task = None
+    queues, procs = [], []
+    ctx = multiprocessing.get_context("fork")
+
+    def start_worker(i: int):
+        q = ctx.Queue(maxsize=UPDATE_QUEUE_SIZE)
+        p = ctx.Process(target=_worker_main, args=(i, q), name=f"astrobot-worker-{i}")
+        p.start()
+        return q, p
+
+    if workers > 1:
+        queues, procs = map(list, zip(*(start_worker(i) for i in range(workers))))
+
+    def dispatch(data: dict) -> bool:
+        if processor is not None:
+            return processor.put_nowait(data)
+        i = route_worker(data, workers)
+        if not procs[i].is_alive():
+            return False  # воркер упал — watchdog перезапустит, Telegram пришлёт повтор
+        try:
+            queues[i].put_nowait(data)
+            return True
+        except queue.Full:
+            return False
+
+    async def watchdog():
+        """
+        Перезапускает упавшие воркеры; апдейты из их очередей переходят новому процессу.
+        Если воркеры падают снова и снова — останавливает сервис (SIGTERM себе).
+        """
+        restarts = 0
+        while True:
+            await asyncio.sleep(1)
+            for i, p in enumerate(procs):
+                if p.is_alive():
+                    continue
+                log.error("💥 Воркер %s завершился (код %s)", i, p.exitcode)
+                restarts += 1
+                if restarts > WORKER_MAX_RESTARTS:
+                    log.critical("💥 Воркеры перезапускались уже %s раз — останавливаю сервис", WORKER_MAX_RESTARTS)
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    return
+                old = queues[i]
+                queues[i], procs[i] = start_worker(i)
+                while True:
+                    try:
+                        # get_nowait не ждёт блокировку, если упавший воркер её не отпустил
+                        queues[i].put_nowait(old.get_nowait())
+                    except (queue.Empty, queue.Full):
+                        break
+
+    async def handle(request: web.Request):
+        data = await request.json()
+        update_id = data.get("update_id")
+        if update_id is not None and not await asyncio.to_thread(mark_update_seen, update_id):
+            log.info("♻️ Повтор апдейта %s пропущен", update_id)
+            return web.json_response({"ok": True})
+        if not dispatch(data):
+            # Очередь полна — пусть Telegram пришлёт апдейт позже
+            if update_id is not None:
+                await asyncio.to_thread(unmark_update_seen, update_id)
+            log.warning("⏳ Очередь апдейтов заполнена, %s отклонён", update_id)
+            return web.Response(status=503)
+        return web.json_response({"ok": True})
+
+    async def startup(app):
+        nonlocal processor, watchdog_task
+        await on_startup(dp)
+        if procs:
+            watchdog_task = asyncio.create_task(watchdog())
+        if workers <= 1:
+            processor = UpdateProcessor()
+            processor.start()
+            await start_background()
+
+    async def shutdown(app):
+        # Сначала дорабатываем принятые апдейты, потом финальный сброс в on_shutdown
+        if processor is not None:
+            await processor.stop()
+        if watchdog_task is not None:
+            watchdog_task.cancel()
+            await asyncio.gather(watchdog_task, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        for q, p in zip(queues, procs):
+            if p.is_alive():  # в очередь упавшего воркера никто не читает — put бы завис
+                await loop.run_in_executor(None, q.put, None)
+        # Ждём без таймаута: воркер выходит только после сброса своих буферов
+        for p in procs:
+            await loop.run_in_executor(None, p.join)
+        await on_shutdown(dp)
+        await _close_bot_session()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    log.info("🚀 Webhook: %s воркер(ов), очередь %s, параллельно %s", workers, UPDATE_QUEUE_SIZE, UPDATE_CONCURRENCY)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+
 
 if __name__ == "__main__":
+    if CLI_EXPORT:
+        sys.exit(export_cli(sys.argv[2:]))
     # Render / Railway webhook runner
-    start_webhook(
-        dispatcher=dp,
-        webhook_path=WEBHOOK_PATH,
-        on_startup=on_startup,
-        on_shutdown=on_shutdown,
-        skip_updates=True,
-        host=WEBAPP_HOST,
-        port=WEBAPP_PORT,
-    )
+    run_webhook(WEB_WORKERS)